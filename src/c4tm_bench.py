@@ -0,0 +1,504 @@
+#!/usr/bin/python
+# Benchmarks for the c4tm_model layer. Runs against an in-memory game DB.
+#   python c4tm_bench.py [benchmark_name ...]
+# The suite times the main model calls on generated campaigns of several
+# sizes and writes the results as JSON, for comparing commits:
+#   python c4tm_bench.py suite [--sizes 1000,10000,100000] [--output results.json]
+import sqlite3, sys, time, os, tempfile, shutil, json, tracemalloc, random, argparse, platform, subprocess
+from c4tm_model import CivTroopManager
+
+class QueryCounter(object):
+    """Counts SQL statements executed on a connection (via the trace callback)."""
+    def __init__(self, gameDb):
+        self.count = 0
+        gameDb.set_trace_callback(self)
+        
+    def __call__(self, statement):
+        self.count += 1
+        
+    def reset(self):
+        count, self.count = self.count, 0
+        return count
+
+def build_sample_game(manager, composite_count=10, units_per_composite=20, events_per_unit=20):
+    year = -4000
+    for composite_index in range(composite_count):
+        composite_id = manager.create_unit(year, "Army %d" % composite_index, manager.COMPOSITE_UNIT_TYPE, "Capital")
+        for unit_index in range(units_per_composite):
+            unit_id = manager.create_unit(year, "Unit %d.%d" % (composite_index, unit_index), "warrior", "Capital")
+            manager.assign_unit_to_composite(unit_id, year, composite_id)
+            for event_index in range(events_per_unit):
+                event_year = year + 10*(event_index+1)
+                if event_index % 5 == 4:
+                    manager.promote_unit(unit_id, event_year, "Combat %d" % event_index)
+                else:
+                    manager.move_unit(unit_id, event_year, "City %d" % event_index)
+    manager.commit()
+    
+def bench_unit_view_queries():
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    build_sample_game(manager)
+    counter = QueryCounter(gameDb)
+    unit_ids = sorted(manager.get_unit_list())
+    
+    results = {}
+    counter.reset()
+    start = time.perf_counter()
+    for unit_id in unit_ids:
+        manager._invalidate_cache(None)
+        manager.get_unit_view(unit_id)
+    elapsed = time.perf_counter() - start
+    results["get_unit_view queries/call"] = counter.reset() / len(unit_ids)
+    results["get_unit_view ms/call"] = 1000 * elapsed / len(unit_ids)
+    
+    for unit_id in unit_ids:
+        manager.get_unit_lifespan(unit_id)
+    results["get_unit_lifespan queries/call"] = counter.reset() / len(unit_ids)
+    
+    manager.get_unit_list(live_only=True)
+    results["get_unit_list(live_only) queries"] = counter.reset()
+    return results
+    
+def bench_unit_views_batch():
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    build_sample_game(manager)
+    counter = QueryCounter(gameDb)
+    year = -3900
+    
+    results = {}
+    counter.reset()
+    start = time.perf_counter()
+    unit_ids = manager.get_unit_list(year)
+    for unit_id in unit_ids:
+        manager.get_unit_view(unit_id, year)
+    results["per-unit get_unit_view ms"] = 1000 * (time.perf_counter() - start)
+    results["per-unit get_unit_view queries"] = counter.reset()
+    
+    manager._invalidate_cache(None)
+    start = time.perf_counter()
+    unit_ids = manager.get_unit_list(year)
+    manager.get_unit_views(unit_ids, year)
+    results["batched get_unit_views ms"] = 1000 * (time.perf_counter() - start)
+    results["batched get_unit_views queries"] = counter.reset()
+    return results
+    
+def bench_year_stepping():
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    build_sample_game(manager)
+    unit_ids = manager.get_unit_list()
+    years = list(range(-3990, -3790, 10))
+    
+    results = {}
+    start = time.perf_counter()
+    for year in years:
+        manager._invalidate_cache(None)
+        manager.get_unit_views(unit_ids, year)
+    results["from scratch ms/step"] = 1000 * (time.perf_counter() - start) / len(years)
+    
+    manager._invalidate_cache(None)
+    start = time.perf_counter()
+    for year in years:
+        manager.get_unit_views(unit_ids, year)
+    results["incremental ms/step"] = 1000 * (time.perf_counter() - start) / len(years)
+    return results
+    
+def bench_ingest():
+    unit_count, turns = 200, 50
+    def turn_records(turn):
+        records = []
+        for unit_id in range(1, unit_count+1):
+            year = -3990 + 10*turn
+            if unit_id % 3 == 0:
+                records.append(CivTroopManager.EventRecord(unit_id, year, "promote", {"promotion": "Combat %d" % turn}))
+            else:
+                records.append(CivTroopManager.EventRecord(unit_id, year, "move", {"location": "City %d" % turn}))
+        return records
+    # on disk, so the per-statement journal work is counted
+    tempDir = tempfile.mkdtemp()
+    def new_game():
+        manager = CivTroopManager(sqlite3.connect(os.path.join(tempDir, "ingest%d.db" % len(os.listdir(tempDir)))))
+        for unit_id in range(1, unit_count+1):
+            manager.create_unit(-4000, "Unit %d" % unit_id, "warrior", "Capital")
+        manager.commit()
+        return manager
+    
+    results = {}
+    manager = new_game()
+    start = time.perf_counter()
+    for turn in range(turns):
+        with manager:
+            for unit_id, year, event_type, event_data in turn_records(turn):
+                if event_type == "move":
+                    manager.move_unit(unit_id, year, event_data["location"])
+                else:
+                    manager.promote_unit(unit_id, year, event_data["promotion"])
+    results["mutators events/s"] = unit_count * turns / (time.perf_counter() - start)
+    
+    manager = new_game()
+    start = time.perf_counter()
+    for turn in range(turns):
+        with manager:
+            manager.apply_events(turn_records(turn))
+    results["apply_events events/s"] = unit_count * turns / (time.perf_counter() - start)
+    shutil.rmtree(tempDir)
+    return results
+    
+def bench_location_query():
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    build_sample_game(manager, composite_count=20)
+    counter = QueryCounter(gameDb)
+    year = -3850
+    
+    results = {}
+    manager._invalidate_cache(None)
+    counter.reset()
+    start = time.perf_counter()
+    unit_views = manager.get_unit_views(manager.get_unit_list(year, live_only=True), year)
+    [unit_id for unit_id, unit_view in unit_views.items() if unit_view.location == "City 13"]
+    results["views + filter ms"] = 1000 * (time.perf_counter() - start)
+    results["views + filter queries"] = counter.reset()
+    
+    start = time.perf_counter()
+    manager.units_at_location("City 13", year)
+    results["units_at_location ms"] = 1000 * (time.perf_counter() - start)
+    results["units_at_location queries"] = counter.reset()
+    return results
+    
+def bench_timeline():
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    build_sample_game(manager)
+    min_year, max_year = manager.get_min_max_years()
+    years = list(range(min_year, max_year+1, 10))
+    
+    results = {}
+    start = time.perf_counter()
+    for year in years:
+        manager.get_unit_views(manager.get_unit_list(year), year)
+    results["get_unit_views per year ms"] = 1000 * (time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    for year, unit_views in manager.iter_timeline(years):
+        pass
+    results["iter_timeline ms"] = 1000 * (time.perf_counter() - start)
+    results["years"] = len(years)
+    return results
+    
+def bench_diff_years():
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    build_sample_game(manager)
+    counter = QueryCounter(gameDb)
+    year_a, year_b = -3900, -3890
+    
+    results = {}
+    counter.reset()
+    start = time.perf_counter()
+    views_a = manager.get_unit_views(manager.get_unit_list(year_a), year_a)
+    views_b = manager.get_unit_views(manager.get_unit_list(year_b), year_b)
+    [unit_id for unit_id in views_b if unit_id not in views_a or views_a[unit_id].location != views_b[unit_id].location]
+    results["two view sets ms"] = 1000 * (time.perf_counter() - start)
+    results["two view sets queries"] = counter.reset()
+    
+    start = time.perf_counter()
+    manager.diff_years(year_a, year_b)
+    results["diff_years ms"] = 1000 * (time.perf_counter() - start)
+    results["diff_years queries"] = counter.reset()
+    return results
+    
+CAMPAIGN_UNIT_TYPES = ["warrior", "archer", "axeman", "spearman", "swordsman", "catapult", "horse_archer", "knight"]
+
+def generate_campaign(manager, seed=0, unit_count=1000, events_per_unit=10, start_year=-4000, turn_years=10):
+    """Fills an empty game with a campaign that depends only on the arguments.
+    About one unit in 20 is a composite, and half the composites are nested
+    in an earlier one. The other units join a composite when created, then 
+    get events_per_unit moves, promotions, victories, reassignments, renames,
+    upgrades and notes on random later turns; one in ten ends destroyed.
+    Written a turn at a time with apply_events. Returns the number of events."""
+    rng = random.Random(seed)
+    turn_count = 2 * events_per_unit + 10
+    composite_count = max(1, unit_count // 20)
+    unit_ids = list(manager.reserve_unit_ids(unit_count))
+    composite_ids = unit_ids[:composite_count]
+    turns = [[] for turn in range(turn_count)]
+    def record(turn, unit_id, event_type, **event_data):
+        turns[turn].append(CivTroopManager.EventRecord(unit_id, start_year + turn_years*turn, event_type, event_data))
+        
+    for index, unit_id in enumerate(composite_ids):
+        record(0, unit_id, "create", name="Army %d" % index, unit_type=CivTroopManager.COMPOSITE_UNIT_TYPE, location="Capital")
+        if index and rng.random() < 0.5:
+            record(0, unit_id, "assign", composite_unit_id=composite_ids[rng.randrange(index)])
+        for turn in sorted(rng.sample(range(1, turn_count), max(1, events_per_unit // 4))):
+            record(turn, unit_id, "transferhq", location="City %d" % rng.randrange(100))
+            
+    for unit_id in unit_ids[composite_count:]:
+        created = rng.randrange(10)
+        record(created, unit_id, "create", name="Unit %d" % unit_id, unit_type=rng.choice(CAMPAIGN_UNIT_TYPES), location="Capital")
+        record(created, unit_id, "assign", composite_unit_id=rng.choice(composite_ids))
+        event_turns = sorted(rng.sample(range(created+1, turn_count), events_per_unit))
+        for turn in event_turns:
+            roll = rng.random()
+            if roll < 0.45:
+                record(turn, unit_id, "move", location="City %d" % rng.randrange(100))
+            elif roll < 0.60:
+                record(turn, unit_id, "promote", promotion="Combat %d" % rng.randrange(6))
+            elif roll < 0.75:
+                record(turn, unit_id, "victory", enemy_unit_owner="Player %d" % rng.randrange(8), 
+                       enemy_unit_type=rng.choice(CAMPAIGN_UNIT_TYPES))
+            elif roll < 0.85:
+                record(turn, unit_id, "assign", composite_unit_id=rng.choice(composite_ids))
+            elif roll < 0.90:
+                record(turn, unit_id, "rename", name="Veteran %d" % unit_id)
+            elif roll < 0.95:
+                record(turn, unit_id, "upgrade", unit_type=rng.choice(CAMPAIGN_UNIT_TYPES))
+            else:
+                record(turn, unit_id, "history", note="Held the line at City %d" % rng.randrange(100))
+        if rng.random() < 0.1:
+            record(event_turns[-1], unit_id, "destroy", enemy_unit_owner="Player %d" % rng.randrange(8), 
+                   enemy_unit_type=rng.choice(CAMPAIGN_UNIT_TYPES))
+                   
+    for turn_records in turns:
+        with manager:
+            manager.apply_events(turn_records)
+    return sum(len(turn_records) for turn_records in turns)
+    
+def headless_tree_fill(manager, year=None):
+    # What Civ4TroopManager_tkinterView._fillTreeHierarchy does, with a 
+    # dict of unit_id -> parent unit_id in place of the Tk tree.
+    unit_ids = manager.get_unit_list(year)
+    unit_views = manager.get_unit_views(unit_ids, year)
+    tree = {}
+    for unit_id in unit_ids:
+        unit_view = unit_views[unit_id]
+        if unit_view.is_dead or unit_view.id in tree: continue
+        tree[unit_view.id] = None
+        while unit_view.composite_unit_id != None:
+            tree[unit_view.id] = unit_view.composite_unit_id
+            if unit_view.composite_unit_id in tree:
+                break
+            parent_view = unit_views.get(unit_view.composite_unit_id, None)
+            if parent_view is None:
+                parent_view = manager.get_unit_view(unit_view.composite_unit_id, year)
+            tree[parent_view.id] = None
+            unit_view = parent_view
+    return tree
+    
+def run_suite_size(unit_count, events_per_unit, seed, temp_dir):
+    results = {}
+    manager = CivTroopManager(sqlite3.connect(os.path.join(temp_dir, "campaign%d.db" % unit_count)))
+    start = time.perf_counter()
+    results["events"] = generate_campaign(manager, seed, unit_count, events_per_unit)
+    results["generate s"] = time.perf_counter() - start
+    
+    rng = random.Random(seed)
+    min_year, max_year = manager.get_min_max_years()
+    unit_ids = manager.get_unit_list()
+    samples = [(rng.choice(unit_ids), rng.randrange(min_year, max_year+1)) for sample in range(200)]
+    manager._invalidate_cache(None)
+    start = time.perf_counter()
+    for unit_id, year in samples:
+        manager.get_unit_view(unit_id, year)
+    results["get_unit_view cold ms/call"] = 1000 * (time.perf_counter() - start) / len(samples)
+    start = time.perf_counter()
+    for unit_id, year in samples:
+        manager.get_unit_view(unit_id, year)
+    results["get_unit_view warm ms/call"] = 1000 * (time.perf_counter() - start) / len(samples)
+    
+    years = [rng.randrange(min_year, max_year+1) for sample in range(20)]
+    start = time.perf_counter()
+    for year in years:
+        manager.get_unit_list(year, live_only=True)
+    results["get_unit_list(live_only) ms/call"] = 1000 * (time.perf_counter() - start) / len(years)
+    
+    start = time.perf_counter()
+    for repeat in range(20):
+        manager.get_min_max_years()
+    results["get_min_max_years ms/call"] = 1000 * (time.perf_counter() - start) / 20
+    
+    for label, year in (("latest", None), ("mid game", (min_year + max_year) // 2)):
+        manager._invalidate_cache(None)
+        start = time.perf_counter()
+        headless_tree_fill(manager, year)
+        results["tree fill %s cold ms" % label] = 1000 * (time.perf_counter() - start)
+        start = time.perf_counter()
+        headless_tree_fill(manager, year)
+        results["tree fill %s warm ms" % label] = 1000 * (time.perf_counter() - start)
+        
+    deletions = 0
+    start = time.perf_counter()
+    for unit_id in rng.sample(unit_ids, min(50, len(unit_ids))):
+        unit_events = [e for e in manager.get_events_list(unit_id) if e.event_type not in ("create", "assign_to")]
+        if unit_events:
+            with manager:
+                manager.delete_event(unit_events[-1].event_id)
+            deletions += 1
+    results["delete_event ms/call"] = 1000 * (time.perf_counter() - start) / max(1, deletions)
+    manager.connection.close()
+    return results
+    
+def run_suite(sizes=(1000, 10000, 100000), events_per_unit=10, seed=0):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, 
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    suite = {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "seed": seed,
+        "events_per_unit": events_per_unit,
+        "results": {},
+    }
+    # on disk, as the GUI uses it
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for unit_count in sizes:
+            suite["results"][str(unit_count)] = run_suite_size(unit_count, events_per_unit, seed, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+    return suite
+    
+class EagerEventView(object):
+    """EventView as it was before lazy decoding, for comparison."""
+    def __init__(self, event_id, unit_id, year, event_type_id, event_json):
+        self.event_id = event_id
+        self.unit_id = unit_id
+        self.year = year
+        self.type_id = event_type_id
+        self.event_type = CivTroopManager.EVENT_TYPES[event_type_id]
+        self.event_json = event_json
+        self.event_data = json.loads(event_json)
+        
+def build_move_events(gameDb, event_count):
+    # event_count move events spread over 1000 units, straight into unit_events
+    move_id = CivTroopManager.EVENT_TYPES.index("move")
+    rows = ((event_index % 1000 + 1, -4000 + event_index // 1000, move_id, json.dumps({"location": "City %d" % (event_index % 50)}))
+            for event_index in range(event_count))
+    gameDb.executemany("INSERT into unit_events (unit_id, year, event_type_id, event_json) VALUES (?, ?, ?, ?)", rows)
+    gameDb.commit()
+    
+def bench_event_views(event_count=1000000):
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    move_id = manager.EVENT_TYPES.index("move")
+    build_move_events(gameDb, event_count)
+    
+    def scan(view_class):
+        # what lifespan-style callers do: build the views, read year and type
+        events = [view_class(*row) for row in gameDb.execute("SELECT %s FROM unit_events" % manager.EVENT_COLUMNS)]
+        return sum(1 for e in events if e.type_id == move_id and e.year <= 0)
+        
+    results = {}
+    for label, view_class in (("eager", EagerEventView), ("lazy", CivTroopManager.EventView)):
+        start = time.perf_counter()
+        scan(view_class)
+        results["%s ms" % label] = 1000 * (time.perf_counter() - start)
+        tracemalloc.start()
+        scan(view_class)
+        results["%s peak MB" % label] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return results
+    
+def bench_iter_events(event_count=1000000):
+    gameDb = sqlite3.connect(":memory:")
+    manager = CivTroopManager(gameDb)
+    build_move_events(gameDb, event_count)
+    
+    def fetch_all():
+        c = manager._select_events(manager.EVENT_COLUMNS, order_by="year, event_id")
+        return len([manager.EventView(*row) for row in c.fetchall()])
+        
+    results = {}
+    for label, walk in (("fetchall", fetch_all), ("iter_events", lambda: sum(1 for e in manager.iter_events()))):
+        start = time.perf_counter()
+        walk()
+        results["%s ms" % label] = 1000 * (time.perf_counter() - start)
+        tracemalloc.start()
+        walk()
+        results["%s peak MB" % label] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return results
+    
+# Budgets (ms, cumulative, bytecode cached) for importing each module on its
+# own. None of them may load tkinter; only the GUI, civ4troopmanager, does.
+IMPORT_TIME_BUDGETS_MS = {
+    "c4tm_core": 5,
+    "civgamedata": 20,
+    "c4tm_model": 40,
+}
+
+def import_time(module, runs=5):
+    """Best of runs cumulative import time (ms) of module in a fresh
+    interpreter, via python -X importtime, and the modules it loaded."""
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable, "-X", "importtime", "-c", "import %s" % module]
+    # the first run writes the bytecode cache
+    subprocess.run(command, env=env, capture_output=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    for run in range(runs):
+        output = subprocess.run(command, env=env, capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+        loaded = set()
+        for line in output.splitlines():
+            if not line.startswith("import time:") or "|" not in line: continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            loaded.add(name.strip())
+            if name.strip() == module and not name[1:].startswith(" "):
+                elapsed = int(cumulative_us) / 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, loaded
+
+def bench_import_time():
+    results = {}
+    for module, budget in IMPORT_TIME_BUDGETS_MS.items():
+        elapsed, loaded = import_time(module)
+        results["%s ms" % module] = elapsed
+        if "tkinter" in loaded:
+            raise Exception("importing %s loaded tkinter" % module)
+        if elapsed > budget:
+            raise Exception("importing %s took %0.1f ms, budget %d ms" % (module, elapsed, budget))
+    return results
+    
+BENCHMARKS = {
+    "unit_view_queries": bench_unit_view_queries,
+    "unit_views_batch": bench_unit_views_batch,
+    "year_stepping": bench_year_stepping,
+    "ingest": bench_ingest,
+    "event_views": bench_event_views,
+    "location_query": bench_location_query,
+    "iter_events": bench_iter_events,
+    "timeline": bench_timeline,
+    "diff_years": bench_diff_years,
+    "import_time": bench_import_time,
+}
+
+def suite_main(args):
+    parser = argparse.ArgumentParser(prog="c4tm_bench.py suite")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated unit counts")
+    parser.add_argument("--events-per-unit", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON results file (default: stdout)")
+    options = parser.parse_args(args)
+    suite = run_suite([int(size) for size in options.sizes.split(",")], options.events_per_unit, options.seed)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(suite, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(suite, indent=2, sort_keys=True))
+    
+if __name__=="__main__":
+    if sys.argv[1:2] == ["suite"]:
+        suite_main(sys.argv[2:])
+        sys.exit(0)
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        print(name)
+        for metric, value in BENCHMARKS[name]().items():
+            print("  %-40s %10.3f" % (metric, value))
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# Differential check of the model's caches. Plays random edits (mutators,
+# apply_events, delete_event, undo, edits committed from a second connection,
+# convert_to_column_events) and compares what CivTroopManager returns -
+# get_unit_views through the view cache and checkpoints or as of an event,
+# iter_timeline, lifespans and membership - with a naive replay of the raw
+# events.
+#   python c4tm_check.py [--seed 0] [--rounds 20] [--ops 150]
+# Prints the first difference with the seed and step that produced it.
+import sqlite3, os, sys, json, random, tempfile, shutil, argparse
+from c4tm_model import CivTroopManager
+
+class Mismatch(Exception):
+    pass
+
+def naive_state(manager, year, as_of_event_id=None):
+    """{unit_id: state dict} as of year (None for latest), or just after
+    event as_of_event_id in year, by folding every event in order, with
+    nothing cached."""
+    units = {}
+    joined = {}
+    for e in manager.iter_events(max_year=year):
+        if as_of_event_id is not None and e.year == year and e.event_id > as_of_event_id:
+            break
+        unit = units.get(e.unit_id, None)
+        if unit is None:
+            unit = units[e.unit_id] = {"name": "", "unit_type": "", "HQ": "", "location": "", "composite_unit_id": None,
+                                       "is_dead": False, "destroyed_by": None, "promotions": [], "victories": []}
+        data = e.event_data
+        if e.event_type == "create":
+            unit["name"], unit["unit_type"], unit["location"] = data["name"], data["unit_type"], data["location"]
+            if unit["unit_type"] == manager.COMPOSITE_UNIT_TYPE:
+                unit["HQ"] = unit["location"]
+        elif e.event_type == "rename":
+            unit["name"] = data["name"]
+        elif e.event_type == "upgrade":
+            unit["unit_type"] = data["unit_type"]
+        elif e.event_type == "assign":
+            unit["composite_unit_id"] = data["composite_unit_id"]
+            joined[e.unit_id] = e.year
+        elif e.event_type == "unassign":
+            unit["composite_unit_id"] = None
+        elif e.event_type == "promote":
+            unit["promotions"].append(data["promotion"])
+        elif e.event_type == "move":
+            unit["location"] = data["location"]
+        elif e.event_type == "transferhq":
+            unit["HQ"] = data["location"]
+        elif e.event_type == "destroy":
+            unit["is_dead"] = True
+            if data["enemy_unit_owner"] is not None:
+                unit["destroyed_by"] = [data["enemy_unit_type"], data["enemy_unit_owner"]]
+        elif e.event_type == "victory":
+            unit["victories"].append([e.year, data["enemy_unit_type"], data["enemy_unit_owner"]])
+    for unit_id, unit in units.items():
+        unit["id"] = unit_id
+        unit["subordinate_units"] = []
+    for unit_id in sorted(units, key=lambda unit_id: (joined.get(unit_id, float("-inf")), unit_id)):
+        composite = units.get(units[unit_id]["composite_unit_id"], None)
+        if composite is not None and composite["unit_type"] == manager.COMPOSITE_UNIT_TYPE:
+            composite["subordinate_units"].append(unit_id)
+    return units
+
+def normalized(unit_views):
+    # tuples and lists compare equal after a JSON round trip
+    return json.loads(json.dumps(dict((unit_id, unit_view.as_dict()) for unit_id, unit_view in unit_views.items())))
+
+def first_difference(expected, got):
+    for unit_id in sorted(set(expected) | set(got), key=int):
+        if expected.get(unit_id) != got.get(unit_id):
+            return "unit %s: expected %s, got %s" % (unit_id, expected.get(unit_id), got.get(unit_id))
+
+def check_views(manager, years):
+    for year in years:
+        expected = normalized_state(naive_state(manager, year))
+        got = normalized(manager.get_unit_views(sorted(manager.get_unit_list()), year))
+        if expected != got:
+            raise Mismatch("get_unit_views year %s: %s" % (year, first_difference(expected, got)))
+        live = sorted(unit_id for unit_id, unit in expected.items() if not unit["is_dead"])
+        if sorted(str(unit_id) for unit_id in manager.get_unit_list(year, live_only=True)) != sorted(live):
+            raise Mismatch("get_unit_list(%s, live_only) %s, expected %s" % (year, sorted(manager.get_unit_list(year, True)), live))
+        for unit_id, unit in expected.items():
+            if unit["unit_type"] == manager.COMPOSITE_UNIT_TYPE and manager.get_subordinate_units(int(unit_id), year) != unit["subordinate_units"]:
+                raise Mismatch("get_subordinate_units(%s, %s)" % (unit_id, year))
+
+def check_as_of(manager, r):
+    events = list(manager.iter_events())
+    if not events:
+        return
+    e = r.choice(events)
+    expected = normalized_state(naive_state(manager, e.year, e.event_id))
+    got = normalized(manager.get_unit_views(sorted(manager.get_unit_list()), as_of_event_id=e.event_id))
+    if expected != got:
+        raise Mismatch("get_unit_views as of event %d: %s" % (e.event_id, first_difference(expected, got)))
+
+def normalized_state(units):
+    return json.loads(json.dumps(dict((unit_id, unit) for unit_id, unit in units.items())))
+
+def check_timeline(manager, years):
+    for year, unit_views in manager.iter_timeline(years=years):
+        expected = normalized_state(naive_state(manager, year))
+        got = normalized(unit_views)
+        if expected != got:
+            raise Mismatch("iter_timeline year %s: %s" % (year, first_difference(expected, got)))
+
+def check_lifespans(manager):
+    for unit_id in manager.get_unit_list():
+        events = manager.get_events_list(unit_id)
+        destroyed = [e.year for e in events if e.event_type == "destroy"]
+        created = [e.year for e in events if e.event_type == "create"]
+        expected = (created[0], destroyed[0] if destroyed else None)
+        if manager.get_unit_lifespan(unit_id) != expected:
+            raise Mismatch("get_unit_lifespan(%d) %s, expected %s" % (unit_id, manager.get_unit_lifespan(unit_id), expected))
+
+def random_edit(r, manager, step):
+    unit_ids = sorted(manager.get_unit_list())
+    composites = [unit_id for unit_id in unit_ids if manager.is_unit_composite(unit_id)]
+    year = r.randrange(0, 200, 5)
+    op = r.randrange(14)
+    if op == 0 or len(unit_ids) < 4:
+        unit_type = r.random() < 0.25 and manager.COMPOSITE_UNIT_TYPE or r.choice(["warrior", "archer", "axeman"])
+        manager.create_unit(year, "Unit %d" % step, unit_type, "City %d" % r.randrange(5))
+        return
+    unit_id = r.choice(unit_ids)
+    if op == 1:
+        manager.rename_unit(unit_id, year, "Renamed %d" % step)
+    elif op == 2:
+        manager.upgrade_unit(unit_id, year, r.choice(["archer", "pikeman"]))
+    elif op == 3 and composites:
+        manager.assign_unit_to_composite(unit_id, year, r.choice(composites))
+    elif op == 4:
+        manager.unassign_unit_to_composite(unit_id, year)
+    elif op == 5:
+        manager.promote_unit(unit_id, year, "Promotion %d" % step)
+    elif op == 6:
+        manager.move_unit(unit_id, year, "City %d" % r.randrange(5))
+    elif op == 7:
+        manager.transfer_unit_hq(unit_id, year, "City %d" % r.randrange(5))
+    elif op == 8 and r.random() < 0.3:
+        manager.destroy_unit(unit_id, year, r.choice(["Greeks", None]), "archer")
+    elif op == 9:
+        manager.unit_victory(unit_id, year, "Gauls", "axeman")
+    elif op == 10:
+        events = [e for e in manager.get_events_list(unit_id) if e.event_type != "assign_to"]
+        manager.delete_event(r.choice(events).event_id)
+    elif op == 11:
+        batch = [CivTroopManager.EventRecord(None, year, "create", {"name": "Batch %d" % step, "unit_type": "warrior", "location": "City 0"}),
+                 CivTroopManager.EventRecord(unit_id, year + 5, "move", {"location": "City %d" % r.randrange(5)})]
+        if composites:
+            batch.append(CivTroopManager.EventRecord(unit_id, year + 5, "assign", {"composite_unit_id": r.choice(composites)}))
+        manager.apply_events(batch)
+    elif op == 12:
+        manager.undo()
+    else:
+        manager.commit()
+
+def run_check(seed, ops, temp_dir):
+    r = random.Random(seed)
+    filename = os.path.join(temp_dir, "check_%d.db" % seed)
+    manager = CivTroopManager(sqlite3.connect(filename, timeout=0.1))
+    # small limits, so checkpoints, eviction and incremental replay all happen
+    manager.CHECKPOINT_EVENT_INTERVAL = r.choice([2, 4, 8])
+    manager.CHECKPOINT_YEAR_INTERVAL = r.choice([None, 20])
+    manager.VIEW_CACHE_SIZE = r.choice([4, 16, 64])
+    manager.VIEW_CACHE_YEARS = r.choice([0, 1])
+    other = CivTroopManager(sqlite3.connect(filename, timeout=0.1))
+    check_years = [None, 0, 50, 100, 150, 250]
+    try:
+        for step in range(ops):
+            if step == ops // 2 and seed % 2:
+                # odd seeds play the second half on the column format
+                manager.commit()
+                manager.convert_to_column_events()
+            # now and then an edit from another connection, such as the CLI
+            editor = r.random() < 0.1 and other or manager
+            if editor is other:
+                manager.commit()
+                # a plain read replays (and checkpoints) without keeping the write lock
+                manager.reload()
+                manager.get_unit_views(manager.get_unit_list(), r.choice(check_years))
+            try:
+                random_edit(r, editor, step)
+            except Exception as e:
+                if "locked" in str(e):
+                    raise Mismatch("%s left the database locked" % (editor is other and "manager" or "other"))
+                # rejected by validation; the state must be unchanged
+            if editor is other:
+                other.commit()
+            if step % 3 == 0:
+                check_views(manager, r.sample(check_years, 3))
+            if step % 10 == 0:
+                check_lifespans(manager)
+                check_timeline(manager, sorted(r.sample(range(0, 250, 10), 4)))
+                check_as_of(manager, r)
+        check_views(manager, check_years)
+        check_timeline(manager, range(0, 250, 10))
+        check_lifespans(manager)
+    except Mismatch as e:
+        raise Mismatch("seed %d step %d: %s" % (seed, step, e))
+    finally:
+        manager.connection.close()
+        other.connection.close()
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="c4tm_check.py", description="Compare the model's cached views with a naive replay.")
+    parser.add_argument("--seed", type=int, default=0, help="first seed")
+    parser.add_argument("--rounds", type=int, default=20, help="games to play, one seed each")
+    parser.add_argument("--ops", type=int, default=150, help="edits per game")
+    options = parser.parse_args(args)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for seed in range(options.seed, options.seed + options.rounds):
+            run_check(seed, options.ops, temp_dir)
+    except Mismatch as e:
+        print("MISMATCH %s" % e)
+        return 1
+    finally:
+        shutil.rmtree(temp_dir)
+    print("ok: %d games, %d edits each" % (options.rounds, options.ops))
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# Game data helpers shared by the tkinter front-end and scripts. Importing
+# this module does not load tkinter.
+
+class GameDataDisplayKey:
+    def __init__(self, game_data):
+        self._game_data = game_data
+
+    def get_unit_type_display(self, unit_type_key):
+        unit_type_data = self._game_data.get_unit_type(unit_type_key)
+        if unit_type_data is None: return unit_type_key
+        return unit_type_data.get("display", unit_type_key)
+
+    def __call__(self, field_type, field_key):
+        if field_type == "unit_type":
+            return self.get_unit_type_display(field_key)
+        return field_key
+
+class ComputeStrength(object):
+    def __init__(self, unit_data, game_data):
+        self._unit_data = unit_data
+        self._game_data = game_data
+
+    def unit_type_strength(self, unit_type):
+        unit_type_data = self._game_data.get_unit_type(unit_type)
+        if not unit_type_data:
+            raise Exception("No Such UnitType")
+        return unit_type_data["strength"]
+
+    def aggregate_strength(self, unit_view, year=None):
+        if unit_view.unit_type == self._unit_data.COMPOSITE_UNIT_TYPE:
+            aggregate_strength = 0
+            for sub_unit_view in self._unit_data.get_unit_views(unit_view.subordinate_units, year).values():
+                aggregate_strength += self.aggregate_strength(sub_unit_view, year)
+        else:
+            aggregate_strength = self.unit_type_strength(unit_view.unit_type)
+        return aggregate_strength
+
+    def average_strength(self, unit_view, year=None):
+        if unit_view.unit_type == self._unit_data.COMPOSITE_UNIT_TYPE:
+            sub_unit_count = len(unit_view.subordinate_units)
+            if sub_unit_count == 0: return 0
+
+            aggregate_strength = self.aggregate_strength(unit_view, year)
+            average_strength = aggregate_strength / float(sub_unit_count)
+        else:
+            average_strength = self.unit_type_strength(unit_view.unit_type)
+        return average_strength
+
+    def composite(self, unit_view, year=None):
+        if unit_view.unit_type == self._unit_data.COMPOSITE_UNIT_TYPE:
+            return "%d (%0.2f/%d)" % (self.aggregate_strength(unit_view, year),
+                                    self.average_strength(unit_view, year),
+                                    len(unit_view.subordinate_units))
+        else:
+            return "%d%s" % (self.aggregate_strength(unit_view, year), "+"*len(unit_view.promotions))
+
+def entry_to_int(field_name, entry_data, min_val=None, max_val=None):
+    """Parse a form field as an int within [min_val, max_val]. Raises an
+    Exception with a message fit to show the user."""
+    try:
+        i_val = int(entry_data)
+    except (TypeError, ValueError):
+        raise Exception("{} value [{}] is invalid.".format(field_name, entry_data))
+    if min_val is not None and i_val < min_val:
+        raise Exception("{} value {} too small. Minimum value is {}".format(field_name, i_val, min_val))
+    if max_val is not None and i_val > max_val:
+        raise Exception("{} value {} too big. Maximum value is {}".format(field_name, i_val, max_val))
+    return i_val
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# Opens game databases: WAL journaling and tuned pragmas, one writer
+# connection for the mutators and a pool of read-only connections for
+# readers (reports, exports, c4tm_server) that shouldn't block it.
+import sqlite3, os, queue, threading, contextlib
+from urllib.parse import quote
+
+# Applied, in order, to every connection. Change these (or pass pragmas=) to tune.
+#  synchronous NORMAL is safe with WAL: a power cut can lose the last
+#  commits but can't corrupt the game. Negative cache_size is in KiB.
+DEFAULT_PRAGMAS = [
+    ("synchronous", "NORMAL"),
+    ("cache_size", -16000),
+    ("mmap_size", 256 * 2**20),
+    ("temp_store", "MEMORY"),
+]
+# Seconds a connection waits on another's lock before "database is locked"
+BUSY_TIMEOUT = 5.0
+
+def connect(filename, read_only=False, pragmas=None, busy_timeout=BUSY_TIMEOUT, check_same_thread=True):
+    """Open filename with the pragmas applied. A writable connection also
+    switches the database to WAL, which is stored in the file, so read-only
+    connections (which can't switch it) find it already set."""
+    if read_only:
+        gameDb = sqlite3.connect("file:%s?mode=ro" % quote(os.path.abspath(filename)), uri=True,
+                                 timeout=busy_timeout, check_same_thread=check_same_thread)
+    else:
+        gameDb = sqlite3.connect(filename, timeout=busy_timeout, check_same_thread=check_same_thread)
+        journal_mode, = gameDb.execute("PRAGMA journal_mode=WAL").fetchone()
+        if journal_mode.lower() != "wal":
+            raise Exception("Could not switch {} to WAL (journal mode is {})".format(filename, journal_mode))
+    for pragma, value in (DEFAULT_PRAGMAS if pragmas is None else pragmas):
+        gameDb.execute("PRAGMA %s=%s" % (pragma, value))
+    return gameDb
+
+class GameDatabase(object):
+    """One writer connection, for the CivTroopManager doing the edits, and up
+    to max_readers pooled read-only connections, opened as needed.
+    With read_only there is no writer (writer is None) and nothing is
+    written to the file, not even the switch to WAL. on_open_reader, if
+    given, is called with each new reader connection before its first use,
+    outside any transaction."""
+    def __init__(self, filename, max_readers=4, pragmas=None, busy_timeout=BUSY_TIMEOUT, read_only=False, on_open_reader=None):
+        self.filename = filename
+        self._pragmas = pragmas
+        self._busy_timeout = busy_timeout
+        self._on_open_reader = on_open_reader
+        self.writer = None
+        if not read_only:
+            self.writer = connect(filename, pragmas=pragmas, busy_timeout=busy_timeout)
+        self._max_readers = max_readers
+        self._reader_count = 0
+        self._readers = queue.Queue()
+        self._readers_lock = threading.Lock()
+
+    def _checkout_reader(self):
+        with self._readers_lock:
+            if self._readers.empty() and self._reader_count < self._max_readers:
+                self._reader_count += 1
+                try:
+                    gameDb = connect(self.filename, read_only=True, pragmas=self._pragmas,
+                                     busy_timeout=self._busy_timeout, check_same_thread=False)
+                    if self._on_open_reader is not None:
+                        self._on_open_reader(gameDb)
+                except:
+                    self._reader_count -= 1
+                    raise
+                return gameDb
+        return self._readers.get()
+
+    @contextlib.contextmanager
+    def reader(self):
+        """A pooled read-only connection, inside one read transaction so
+        everything read through it comes from the same state of the game.
+        Waits if all max_readers are in use."""
+        gameDb = self._checkout_reader()
+        try:
+            gameDb.execute("BEGIN")
+            try:
+                yield gameDb
+            finally:
+                gameDb.rollback()
+        finally:
+            self._readers.put(gameDb)
+
+    def close(self):
+        # Connections still checked out are closed when they're garbage collected.
+        with self._readers_lock:
+            while not self._readers.empty():
+                self._readers.get().close()
+                self._reader_count -= 1
+        if self.writer is not None:
+            self.writer.close()
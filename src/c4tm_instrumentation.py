@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# Opt-in instrumentation for CivTroopManager. See
+# CivTroopManager.enable_instrumentation and CivTroopManager.stats.
+import collections, contextlib, time
+
+class Instrumentation(object):
+    """Counts SQL statements and time per method (or named block), and keeps
+    a log of the most recent queries slower than slow_query_ms."""
+    SLOW_QUERY_LOG_SIZE = 100
+
+    def __init__(self, slow_query_ms=50):
+        self.slow_query_ms = slow_query_ms
+        self._stack = []
+        self.reset()
+
+    def reset(self):
+        # name -> [calls, sql statements, total seconds, slowest call seconds]
+        self._calls = {}
+        self._sql_count = 0
+        self._slow_queries = collections.deque(maxlen=self.SLOW_QUERY_LOG_SIZE)
+
+    def _record(self, name):
+        record = self._calls.get(name, None)
+        if record is None:
+            record = self._calls[name] = [0, 0, 0.0, 0.0]
+        return record
+
+    def trace(self, statement):
+        # sqlite3 trace callback. Counted once for every method on the stack.
+        self._sql_count += 1
+        for name in set(self._stack):
+            self._calls[name][1] += 1
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        record = self._record(name)
+        record[0] += 1
+        # recursive calls are already inside the outer call's time
+        outer = name not in self._stack
+        self._stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            if outer:
+                record[2] += elapsed
+                record[3] = max(record[3], elapsed)
+
+    def wrap(self, name, method):
+        import inspect
+        if inspect.isgeneratorfunction(method):
+            return self._wrap_generator(name, method)
+        def wrapper(*args, **kwargs):
+            with self.timed(name):
+                return method(*args, **kwargs)
+        return wrapper
+
+    def _wrap_generator(self, name, method):
+        # One call, timed while the generator runs (not while the caller
+        # works on what it yielded).
+        def wrapper(*args, **kwargs):
+            record = self._record(name)
+            record[0] += 1
+            generator = method(*args, **kwargs)
+            spent = 0.0
+            try:
+                while True:
+                    self._stack.append(name)
+                    start = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        spent += time.perf_counter() - start
+                        self._stack.pop()
+                    yield item
+            finally:
+                record[2] += spent
+                record[3] = max(record[3], spent)
+        return wrapper
+
+    def current_method(self):
+        return self._stack and self._stack[-1] or None
+
+    def statement_finished(self, sql, elapsed, method):
+        if 1000 * elapsed >= self.slow_query_ms:
+            self._slow_queries.append({"sql": sql, "ms": 1000 * elapsed, "method": method})
+
+    def snapshot(self):
+        methods = {}
+        for name, (calls, sql, total, slowest) in self._calls.items():
+            methods[name] = {"calls": calls, "sql": sql, "total_ms": 1000 * total, "max_ms": 1000 * slowest}
+        return {
+            "sql_statements": self._sql_count,
+            "methods": methods,
+            "slow_queries": list(self._slow_queries),
+            "slow_query_ms": self.slow_query_ms,
+        }
+
+class InstrumentedConnection(object):
+    """Stands in for the sqlite3 connection so statements can be timed."""
+    def __init__(self, connection, instrumentation):
+        self.connection = connection
+        self._instrumentation = instrumentation
+
+    def cursor(self):
+        return InstrumentedCursor(self.connection.cursor(), self._instrumentation)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __getattr__(self, attr):
+        return getattr(self.connection, attr)
+
+class InstrumentedCursor(object):
+    # A statement's time is its execute plus every fetch, reported to the
+    # instrumentation when the rows run out or the next statement starts.
+    def __init__(self, cursor, instrumentation):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+        self._sql = None
+        self._elapsed = 0.0
+        self._method = None
+
+    def _finish(self):
+        if self._sql is not None:
+            self._instrumentation.statement_finished(self._sql, self._elapsed, self._method)
+            self._sql = None
+
+    def _run(self, execute, sql, params):
+        self._finish()
+        self._sql = sql
+        self._elapsed = 0.0
+        self._method = self._instrumentation.current_method()
+        start = time.perf_counter()
+        try:
+            execute(sql, params)
+        finally:
+            self._elapsed += time.perf_counter() - start
+        return self
+
+    def execute(self, sql, params=()):
+        return self._run(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run(self._cursor.executemany, sql, seq_of_params)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._elapsed += time.perf_counter() - start
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self._cursor.arraysize
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size)
+        self._elapsed += time.perf_counter() - start
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self._cursor)
+        except StopIteration:
+            self._elapsed += time.perf_counter() - start
+            self._finish()
+            raise
+        self._elapsed += time.perf_counter() - start
+        return row
+
+    def __del__(self):
+        self._finish()
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
@@ -1,5 +1,6 @@
 #!/usr/bin/python
-import sqlite3, json
+import sqlite3, json, copy, collections, bisect, contextlib, itertools, sys
+from c4tm_instrumentation import Instrumentation, InstrumentedConnection
         
 
 class CivTroopManager(object):
@@ -20,22 +21,117 @@ class CivTroopManager(object):
     "victory"
     ]
     
+    # event_json keys written for each event type
+    EVENT_DATA_FIELDS = {
+        "create": ["name", "unit_type", "location"],
+        "rename": ["name"],
+        "upgrade": ["unit_type"],
+        "assign": ["composite_unit_id"],
+        "assign_to": ["unit_id"],
+        "unassign": [],
+        "promote": ["promotion"],
+        "move": ["location"],
+        "transferhq": ["location"],
+        "destroy": ["enemy_unit_owner", "enemy_unit_type"],
+        "history": ["note"],
+        "victory": ["enemy_unit_owner", "enemy_unit_type"],
+    }
+    
+    # Result of diff_years. created and destroyed are lists of unit ids; the
+    # rest map unit_id to the value as of the later year (promoted: the list
+    # of promotions gained, reassigned: the composite id or None).
+    YearDiff = collections.namedtuple("YearDiff", ["created", "destroyed", "moved", "renamed", "upgraded", "reassigned", "promoted"])
+    
+    # Payload key -> (column, type) for games converted to typed event
+    # columns by convert_to_column_events.
+    EVENT_PAYLOAD_COLUMNS = {
+        "name": ("name", "text"),
+        "unit_type": ("unit_type", "text"),
+        "location": ("location", "text"),
+        "composite_unit_id": ("composite_unit_id", "integer"),
+        "unit_id": ("member_unit_id", "integer"),
+        "promotion": ("promotion", "text"),
+        "enemy_unit_owner": ("enemy_owner", "text"),
+        "enemy_unit_type": ("enemy_type", "text"),
+        "note": ("note", "text"),
+    }
+    
+    # One event for apply_events. event_data holds the EVENT_DATA_FIELDS of 
+    # event_type. unit_id may be None for "create" to allocate a new id.
+    EventRecord = collections.namedtuple("EventRecord", ["unit_id", "year", "event_type", "event_data"])
+    
+    # Schema migrations, applied in order. The database's PRAGMA user_version
+    # records how many have been applied, so opening an older game DB upgrades
+    # it in place.
+    SCHEMA_MIGRATIONS = [
+        "_migrate_add_event_indexes",
+        "_migrate_add_unit_checkpoints",
+        "_migrate_add_unit_assignments",
+        "_migrate_add_unit_lifespans",
+        "_migrate_add_unit_id_sequence",
+        "_migrate_add_event_search_columns",
+    ]
+    
+    # A replay stores a checkpoint of a unit's state after this many of its
+    # events, and/or once this many years have passed since the previous
+    # checkpoint. None disables either trigger.
+    CHECKPOINT_EVENT_INTERVAL = 64
+    CHECKPOINT_YEAR_INTERVAL = None
+    
+    # (unit, year) views kept by get_unit_views: enough for the whole army at
+    # VIEW_CACHE_YEARS different years, and never fewer than VIEW_CACHE_SIZE.
+    # Set either on a manager to change it. One call caches at most half of
+    # that, so a big batch can't flush everything else.
+    VIEW_CACHE_SIZE = 4096
+    VIEW_CACHE_YEARS = 2
+    
+    # Fields of UnitDataView saved in a checkpoint. History is not saved; it
+    # depends on display_key and the requested year.
+    CHECKPOINT_FIELDS = ["name", "unit_type", "HQ", "location", "composite_unit_id", "is_dead", 
+                         "destroyed_by", "promotions", "victories"]
+    
+    EVENT_COLUMNS = "event_id, unit_id, year, event_type_id, event_json"
+    
+    # get_unit_views filters by unit_id in SQL up to this many units, and
+    # scans all events (skipping unwanted units) beyond it.
+    REPLAY_SCAN_ALL_THRESHOLD = 200
+    
     class EventView:
+        # Most callers only need the year and type, so event_json is decoded
+        # the first time event_data is read.
+        __slots__ = ("event_id", "unit_id", "year", "type_id", "event_json", "_event_data")
+        
         @classmethod
         def sort_by_date_key(cls, event_view):
             return event_view.year, event_view.event_id
             
-        def __init__(self, event_id, unit_id, year, event_type_id, event_json):
+        def __init__(self, event_id, unit_id, year, event_type_id, event_json, event_data=None):
             self.event_id = event_id
             self.unit_id = unit_id
             self.year = year
             self.type_id = event_type_id
-            self.event_type = CivTroopManager.EVENT_TYPES[event_type_id]
             self.event_json = event_json
-            self.event_data = json.loads(event_json)
+            self._event_data = event_data
+            
+        @property
+        def event_type(self):
+            return CivTroopManager.EVENT_TYPES[self.type_id]
+            
+        @property
+        def event_data(self):
+            if self._event_data is None:
+                self._event_data = json.loads(self.event_json)
+            return self._event_data
+            
+        def as_dict(self):
+            return {"event_id": self.event_id, "unit_id": self.unit_id, "year": self.year, 
+                    "event_type": self.event_type, "event_data": self.event_data}
             
     
     class UnitDataView(object):
+        __slots__ = ("name", "id", "unit_type", "HQ", "location", "composite_unit_id", "is_dead", "destroyed_by", 
+                     "promotions", "_history", "_history_loader", "subordinate_units", "victories", "display_key", "display")
+        
         def __init__(self):
             self.name = ""
             self.id = 0
@@ -49,9 +145,37 @@ class CivTroopManager(object):
             self.history = []
             self.subordinate_units = []
             self.victories = []
-            self.display_key = lambda f, v: v
+            self.display_key = CivTroopManager._identity_display_key
             self.display = CivTroopManager.UnitDataDisplayView(self)
             
+        def _copy(self):
+            unit_view = copy.copy(self)
+            unit_view.display = CivTroopManager.UnitDataDisplayView(unit_view)
+            return unit_view
+            
+        # History text is only needed by a few callers (details, delete event),
+        # so replay leaves it out and it is loaded the first time it is read.
+        @property
+        def history(self):
+            if self._history_loader is not None:
+                history_loader, self._history_loader = self._history_loader, None
+                self._history = history_loader(self)
+            return self._history
+            
+        @history.setter
+        def history(self, history):
+            self._history = history
+            self._history_loader = None
+            
+        def as_dict(self, history=False):
+            # for JSON. history is loaded only if asked for.
+            unit_data = dict((field, getattr(self, field)) for field in CivTroopManager.CHECKPOINT_FIELDS)
+            unit_data["id"] = self.id
+            unit_data["subordinate_units"] = self.subordinate_units
+            if history:
+                unit_data["history"] = self.history
+            return unit_data
+            
     class UnitDataDisplayView:
         def __init__(self, unit_view):
             self._unit_view = unit_view
@@ -70,17 +194,136 @@ class CivTroopManager(object):
         #  event_id is really only needed for deletion
         #  Sorting within the same year is order of entry
         #  json converted to dictionary in view
+        #  games converted by convert_to_column_events keep the payload in
+        #  the EVENT_PAYLOAD_COLUMNS instead, and event_json is NULL
         c.execute('''CREATE TABLE IF NOT EXISTS unit_events
             (event_id integer PRIMARY KEY, unit_id integer, year integer, event_type_id integer, event_json text)''')
+        self._load_event_format()
+        self._migrate_schema()
+        
+        # event_type_id -> reducer / history formatter
+        self._reducers = [getattr(self, "_reduce_" + event_type) for event_type in self.EVENT_TYPES]
+        self._history_formatters = [getattr(self, "_history_" + event_type) for event_type in self.EVENT_TYPES]
+        
+        # LRU of views keyed by (unit_id, effective year). See _effective_year.
+        self._unit_view_cache = collections.OrderedDict()
+        self._unit_view_cache_years = {}
+        self._unit_view_cache_hits = 0
+        self._unit_view_cache_misses = 0
+        self._latest_year = None
+        self._latest_year_known = False
+        
+        # In-memory mirror of unit_lifespans, loaded on first use
+        #  unit_id -> [created_year, destroyed_year, is_composite]
+        self._unit_lifespans = None
+        
+        # PRAGMA data_version when the caches above were last known good. See _check_data_version
+        self._data_version = None
         
-        self._unit_view_cache = {}
+        # See enable_instrumentation
+        self._instrumentation = None
+        
+    def _migrate_schema(self):
+        c = self._gameDb.cursor()
+        c.execute("PRAGMA user_version")
+        schema_version, = c.fetchone()
+        if schema_version > len(self.SCHEMA_MIGRATIONS):
+            raise Exception("Game database schema version {} is newer than this program supports ({})".format(
+                schema_version, len(self.SCHEMA_MIGRATIONS)))
+        for migration in self.SCHEMA_MIGRATIONS[schema_version:]:
+            getattr(self, migration)(c)
+            schema_version += 1
+            c.execute("PRAGMA user_version = %d" % schema_version)
+        self._gameDb.commit()
+        
+    def _migrate_add_event_indexes(self, c):
+        # per-unit replay and lifespan lookups: WHERE unit_id=? [AND event_type_id=?] ORDER BY year
+        c.execute("CREATE INDEX IF NOT EXISTS unit_events_by_unit ON unit_events (unit_id, year, event_type_id)")
+        # unit listing by event type: WHERE event_type_id=? AND year<=?
+        c.execute("CREATE INDEX IF NOT EXISTS unit_events_by_type ON unit_events (event_type_id, year, unit_id)")
+        # MIN/MAX(year) and whole-game scans in chronological order
+        c.execute("CREATE INDEX IF NOT EXISTS unit_events_by_year ON unit_events (year)")
+        
+    def _migrate_add_unit_checkpoints(self, c):
+        # Unit state after applying every event up to and including (year, event_id)
+        c.execute('''CREATE TABLE IF NOT EXISTS unit_checkpoints
+            (unit_id integer, year integer, event_id integer, state_json text, PRIMARY KEY (unit_id, year, event_id))''')
+        
+    def _migrate_add_unit_assignments(self, c):
+        # Derived from assign/unassign events: unit_id belongs to composite_id
+        # for years from_year <= year < to_year (to_year NULL while still assigned).
+        c.execute('''CREATE TABLE IF NOT EXISTS unit_assignments
+            (unit_id integer, composite_id integer, from_year integer, to_year integer)''')
+        c.execute("CREATE INDEX IF NOT EXISTS unit_assignments_by_composite ON unit_assignments (composite_id, from_year)")
+        c.execute("CREATE INDEX IF NOT EXISTS unit_assignments_by_unit ON unit_assignments (unit_id, from_year)")
+        c.execute("SELECT DISTINCT unit_id FROM unit_events WHERE event_type_id=?", (self.EVENT_TYPES.index("assign"),))
+        for unit_id, in c.fetchall():
+            self._rebuild_unit_assignments(unit_id)
+        
+    def _migrate_add_unit_lifespans(self, c):
+        # Derived from create/destroy events. Mirrored in memory by _get_lifespans.
+        c.execute('''CREATE TABLE IF NOT EXISTS unit_lifespans
+            (unit_id integer PRIMARY KEY, created_year integer, destroyed_year integer, is_composite integer)''')
+        c.execute("DELETE FROM unit_lifespans")
+        lifespans = {}
+        for e in self._select_events(self._event_columns, event_types=["create", "destroy"], order_by="year, event_id").fetchall():
+            e = self._event_view(e)
+            if e.event_type == "create":
+                lifespans[e.unit_id] = [e.unit_id, e.year, None, e.event_data["unit_type"] == self.COMPOSITE_UNIT_TYPE]
+            elif e.unit_id in lifespans:
+                lifespans[e.unit_id][2] = e.year
+        c.executemany("INSERT INTO unit_lifespans (unit_id, created_year, destroyed_year, is_composite) VALUES (?, ?, ?, ?)",
+                      list(lifespans.values()))
+        
+    def _migrate_add_unit_id_sequence(self, c):
+        # Single row holding the next unit id to hand out. Updating it takes
+        # the database write lock, so two connections can't get the same id.
+        c.execute("CREATE TABLE IF NOT EXISTS unit_id_sequence (next_unit_id integer)")
+        c.execute("DELETE FROM unit_id_sequence")
+        c.execute("INSERT INTO unit_id_sequence (next_unit_id) SELECT COALESCE(MAX(unit_id), 0) + 1 FROM unit_events")
+        
+    def _migrate_add_event_search_columns(self, c):
+        # Indexed views into event_json for find_units_by_name and friends.
+        # Virtual, so nothing is added to the rows on disk.
+        columns = [row[1] for row in c.execute("PRAGMA table_xinfo(unit_events)").fetchall()]
+        for key, collation in (("name", " COLLATE NOCASE"), ("unit_type", ""), ("location", "")):
+            if "json_" + key not in columns:
+                c.execute("ALTER TABLE unit_events ADD COLUMN json_%s text%s GENERATED ALWAYS AS (json_extract(event_json, '$.%s')) VIRTUAL" % 
+                          (key, collation, key))
+        self._create_search_indexes(c)
+        
+    def _create_search_indexes(self, c):
+        # On the json_ columns, or on the payload columns once converted by convert_to_column_events
+        name_column, unit_type_column, location_column = [self._search_column(key) for key in ("name", "unit_type", "location")]
+        c.execute("CREATE INDEX IF NOT EXISTS unit_events_by_%s ON unit_events (%s COLLATE NOCASE, year)" % (name_column, name_column))
+        c.execute("CREATE INDEX IF NOT EXISTS unit_events_by_%s ON unit_events (%s, year)" % (unit_type_column, unit_type_column))
+        c.execute("CREATE INDEX IF NOT EXISTS unit_events_by_%s ON unit_events (%s, year)" % (location_column, location_column))
+        
+    def _search_column(self, key):
+        if self._column_events:
+            return self.EVENT_PAYLOAD_COLUMNS[key][0]
+        return "json_" + key
+        
+    @property
+    def connection(self):
+        """The sqlite3 connection this manager reads and writes through."""
+        return self._gameDb
         
     def commit(self):
         self._gameDb.commit()
         
     def undo(self):
         self._gameDb.rollback()
-        
+        self._invalidate_cache(None)
+        self._unit_lifespans = None
+
+    def reload(self):
+        """Forget everything read from the database, for when another
+        connection has changed it."""
+        self._invalidate_cache(None)
+        self._unit_lifespans = None
+        self._load_event_format()
+
     def __enter__(self):
         return self
         
@@ -92,73 +335,195 @@ class CivTroopManager(object):
             self.undo()
             return False
         
-    def _insert_unit_event(self, unit_id, year, event_type, **event_data):
-        event_json = json.dumps(event_data)
-        query = "INSERT into unit_events (unit_id, year, event_type_id, event_json) VALUES (?, ?, ?, ?)"
-        self._gameDb.execute(query,(unit_id, year, self.EVENT_TYPES.index(event_type), event_json))
-                        
-    def _get_unit_ids(self, min_year=None, max_year=None, event_types = None):
-        unit_ids = []
+    def _load_event_format(self):
+        columns = [row[1] for row in self._gameDb.execute("PRAGMA table_info(unit_events)")]
+        self._column_events = "member_unit_id" in columns
+        if self._column_events:
+            payload_columns = [column for column, column_type in self.EVENT_PAYLOAD_COLUMNS.values()]
+            self._event_columns = "event_id, unit_id, year, event_type_id, " + ", ".join(payload_columns)
+            self._event_insert_query = "INSERT into unit_events (unit_id, year, event_type_id, %s) VALUES (?, ?, ?, %s)" % (
+                ", ".join(payload_columns), ", ".join("?"*len(payload_columns)))
+            # event_type_id -> [(payload key, index into the payload columns)]
+            payload_keys = list(self.EVENT_PAYLOAD_COLUMNS.keys())
+            self._payload_indexes = [[(key, payload_keys.index(key)) for key in self.EVENT_DATA_FIELDS[event_type]] 
+                                     for event_type in self.EVENT_TYPES]
+        else:
+            self._event_columns = self.EVENT_COLUMNS
+            self._event_insert_query = "INSERT into unit_events (unit_id, year, event_type_id, event_json) VALUES (?, ?, ?, ?)"
+            
+    def _event_row(self, unit_id, year, event_type, event_data):
+        if self._column_events:
+            return (unit_id, year, self.EVENT_TYPES.index(event_type)) + tuple(event_data.get(key) for key in self.EVENT_PAYLOAD_COLUMNS)
+        return (unit_id, year, self.EVENT_TYPES.index(event_type), json.dumps(event_data))
+        
+    def _decode_payload(self, event_type_id, payload):
+        # payload is the row after event_type_id: (event_json,) or the payload columns
+        if self._column_events:
+            return dict((key, payload[index]) for key, index in self._payload_indexes[event_type_id])
+        return json.loads(payload[0])
+        
+    def _event_view(self, row):
+        # row is a SELECT of self._event_columns
+        if self._column_events:
+            return self.EventView(row[0], row[1], row[2], row[3], None, self._decode_payload(row[3], row[4:]))
+        return self.EventView(*row)
+        
+    def convert_to_column_events(self):
+        """Moves event payloads from event_json into typed columns. Checks 
+        every event first and changes nothing unless all convert exactly."""
+        if self._column_events:
+            return
+        if self._gameDb.in_transaction:
+            raise Exception("Commit or undo pending changes before converting events")
+        column_types = {"text": str, "integer": int}
+        rows = []
+        for event_id, event_type_id, event_json in self._gameDb.execute("SELECT event_id, event_type_id, event_json FROM unit_events"):
+            event_type = self.EVENT_TYPES[event_type_id]
+            event_data = json.loads(event_json)
+            if sorted(event_data.keys()) != sorted(self.EVENT_DATA_FIELDS[event_type]):
+                raise Exception("Event %d (%s) has fields %s, expected %s" % (event_id, event_type, sorted(event_data.keys()), 
+                                                                              self.EVENT_DATA_FIELDS[event_type]))
+            for key, value in event_data.items():
+                column, column_type = self.EVENT_PAYLOAD_COLUMNS[key]
+                if value is not None and type(value) is not column_types[column_type]:
+                    raise Exception("Event %d (%s): %s=%r does not fit a %s column" % (event_id, event_type, key, value, column_type))
+            rows.append(tuple(event_data.get(key) for key in self.EVENT_PAYLOAD_COLUMNS) + (event_id,))
+            
         c = self._gameDb.cursor()
-        if not event_types:
-            event_types = [None]
-        for event_type in event_types:
-            query = "SELECT DISTINCT (unit_id) FROM unit_events"
+        c.execute("BEGIN")
+        try:
+            # The json_ search columns would only hold NULLs from here on, but
+            # each insert would still evaluate them for their indexes. Dropped
+            # first, so the UPDATE doesn't maintain those indexes either.
+            columns = [row[1] for row in c.execute("PRAGMA table_xinfo(unit_events)").fetchall()]
+            for key in ("name", "unit_type", "location"):
+                c.execute("DROP INDEX IF EXISTS unit_events_by_json_%s" % key)
+                if "json_" + key in columns:
+                    c.execute("ALTER TABLE unit_events DROP COLUMN json_%s" % key)
+            for key, (column, column_type) in self.EVENT_PAYLOAD_COLUMNS.items():
+                # names compare case insensitively, as json_name did, so LIKE and = can use the name index
+                collation = key == "name" and " COLLATE NOCASE" or ""
+                c.execute("ALTER TABLE unit_events ADD COLUMN %s %s%s" % (column, column_type, collation))
+            c.executemany("UPDATE unit_events SET %s, event_json=NULL WHERE event_id=?" % 
+                          ", ".join("%s=?" % column for column, column_type in self.EVENT_PAYLOAD_COLUMNS.values()), rows)
+        except:
+            self._gameDb.rollback()
+            raise
+        self._gameDb.commit()
+        self._load_event_format()
+        self._create_search_indexes(self._gameDb.cursor())
+        self._gameDb.commit()
+        
+    def _insert_unit_event(self, unit_id, year, event_type, /, **event_data):
+        self._gameDb.execute(self._event_insert_query, self._event_row(unit_id, year, event_type, event_data))
+        self._invalidate_checkpoints(unit_id, year)
+        if self._latest_year_known and (self._latest_year is None or year > self._latest_year):
+            self._latest_year = year
+        
+    @classmethod
+    def _compile_event_query(cls, select, unit_count, type_count, has_min_year, has_max_year, order_by, keyset=None, has_limit=False):
+        # Query strings depend only on the shape of the filter, so build each
+        # shape once and reuse it (sqlite3 also caches the prepared statement
+        # by its text).
+        key = (select, unit_count, type_count, has_min_year, has_max_year, order_by, keyset, has_limit)
+        query = cls._compiled_event_queries.get(key)
+        if query is None:
             conditionals = []
-            params = []
-            
-            if event_type is not None:
-                event_type_id = self.EVENT_TYPES.index(event_type)
+            if unit_count == 1:
+                conditionals.append("unit_id=?")
+            elif unit_count > 1:
+                conditionals.append("unit_id IN (%s)" % ",".join("?"*unit_count))
+            if type_count == 1:
                 conditionals.append("event_type_id=?")
-                params.append(event_type_id)
-            if min_year is not None:
+            elif type_count > 1:
+                conditionals.append("event_type_id IN (%s)" % ",".join("?"*type_count))
+            if has_min_year:
                 conditionals.append("year>=?")
-                params.append(min_year)
-            if max_year is not None:
+            if has_max_year:
                 conditionals.append("year<=?")
-                params.append(max_year)
+            if keyset:
+                conditionals.append("(year, event_id) %s (?, ?)" % keyset)
+            query = "SELECT %s FROM unit_events" % select
             if conditionals:
                 query += " WHERE " + " AND ".join(conditionals)
-            c.execute(query, tuple(params))
-            results = c.fetchall()
-            for result in results:
-                unit_id, = result
-                unit_ids.append(unit_id)
-        return set(unit_ids)
+            if order_by:
+                query += " ORDER BY " + order_by
+            if has_limit:
+                query += " LIMIT ?"
+            cls._compiled_event_queries[key] = query
+        return query
+    _compiled_event_queries = {}
+    
+    def _select_events(self, select, unit_ids=(), min_year=None, max_year=None, event_types=None, order_by=None, 
+                       after=None, before=None, limit=None):
+        # after/before: only events strictly after/before this (year, event_id)
+        params = list(unit_ids)
+        type_count = 0
+        if event_types:
+            type_count = len(event_types)
+            params += [self.EVENT_TYPES.index(event_type) for event_type in event_types]
+        if min_year is not None:
+            params.append(min_year)
+        if max_year is not None:
+            params.append(max_year)
+        keyset = None
+        if after is not None:
+            keyset = ">"
+            params += list(after)
+        elif before is not None:
+            keyset = "<"
+            params += list(before)
+        if limit is not None:
+            params.append(limit)
+        query = self._compile_event_query(select, len(unit_ids), type_count, 
+                                          min_year is not None, max_year is not None, order_by, keyset, limit is not None)
+        return self._gameDb.execute(query, params)
+                        
+    def _get_unit_ids(self, min_year=None, max_year=None, event_types = None):
+        c = self._select_events("DISTINCT unit_id", min_year=min_year, max_year=max_year, event_types=event_types)
+        return set(unit_id for unit_id, in c.fetchall())
     
     def _get_unit_events(self, unit_id, min_year=None, max_year=None, event_types=None):
-        events = []
-        c = self._gameDb.cursor()
-        if not event_types:
-            event_types = [None]
-        for event_type in event_types:
-            query = "SELECT * FROM unit_events WHERE unit_id=?"
-            params = [unit_id]
+        c = self._select_events(self._event_columns, (unit_id,), min_year, max_year, event_types, order_by="year, event_id")
+        return [self._event_view(result) for result in c.fetchall()]
+        
+    def _check_data_version(self):
+        # data_version changes when another connection (the CLI, a second
+        # copy of the GUI) commits, and then nothing cached can be trusted.
+        data_version, = self._gameDb.execute("PRAGMA data_version").fetchone()
+        if data_version != self._data_version:
+            if self._data_version is not None:
+                self.reload()
+            self._data_version = data_version
             
-            if event_type is not None:
-                query += " AND event_type_id=?"
-                event_type_id = self.EVENT_TYPES.index(event_type)
-                params.append(event_type_id)
-            if min_year is not None:
-                query += " AND year>=? "
-                params.append(min_year)
-            if max_year is not None:
-                query += " AND year<=?"
-                params.append(max_year)
-            c.execute(query, tuple(params))
-            results = c.fetchall()
-            for result in results:
-                events.append(self.EventView(*result))
-        events.sort(key=self.EventView.sort_by_date_key) # return sorted by year
-        return events
+    def _get_lifespans(self):
+        self._check_data_version()
+        if self._unit_lifespans is None:
+            c = self._gameDb.execute("SELECT unit_id, created_year, destroyed_year, is_composite FROM unit_lifespans")
+            self._unit_lifespans = dict((unit_id, [created_year, destroyed_year, bool(is_composite)]) 
+                                        for unit_id, created_year, destroyed_year, is_composite in c)
+        return self._unit_lifespans
+        
+    def _set_unit_lifespan(self, unit_id, created_year, destroyed_year, is_composite):
+        self._gameDb.execute("INSERT OR REPLACE INTO unit_lifespans (unit_id, created_year, destroyed_year, is_composite) VALUES (?, ?, ?, ?)",
+                             (unit_id, created_year, destroyed_year, is_composite))
+        self._get_lifespans()[unit_id] = [created_year, destroyed_year, is_composite]
+        
+    def _delete_unit_lifespan(self, unit_id):
+        self._gameDb.execute("DELETE FROM unit_lifespans WHERE unit_id=?", (unit_id,))
+        self._get_lifespans().pop(unit_id, None)
         
     def is_unit_composite(self, unit_id):
-        create_events = self._get_unit_events(unit_id, event_types=["create"])
-        create_event = create_events[0]
-        return create_event.event_data["unit_type"] == self.COMPOSITE_UNIT_TYPE
+        lifespan = self._get_lifespans().get(unit_id, None)
+        if lifespan is None:
+            raise Exception("No such unit with ID %d" % unit_id)
+        return lifespan[2]
                 
-    def _raise_if_invalid_year(self, unit_id, year):
-        yearCreated, yearDestroyed = self.get_unit_lifespan(unit_id)
+    def _raise_if_invalid_year(self, unit_id, year, lifespans=None):
+        if lifespans is None:
+            yearCreated, yearDestroyed = self.get_unit_lifespan(unit_id)
+        else:
+            yearCreated, yearDestroyed = lifespans.get(unit_id, (None, None, False))[:2]
         if yearCreated == None:
             raise Exception("No such unit with ID %d" % unit_id)
         if year < yearCreated:
@@ -166,28 +531,253 @@ class CivTroopManager(object):
         if yearDestroyed != None and year > yearDestroyed:
             raise Exception("Cannot insert an event in year %d after it was destroyed in year %d" % (year, yearDestroyed))
             
-    def _invalidate_cache(self, unit_id):
-        if unit_id in self._unit_view_cache.keys():
-            del self._unit_view_cache[unit_id]
+    def _invalidate_cache(self, unit_id, year=None):
+        # Drop cached views of unit_id (None for every unit) as of 'year' or
+        # later (None for every year). A view cached as "latest" is always dropped.
+        if unit_id is None:
+            unit_ids = list(self._unit_view_cache_years.keys())
+            self._latest_year_known = False
+        else:
+            unit_ids = [unit_id]
+        for unit_id in unit_ids:
+            cache_years = self._unit_view_cache_years.get(unit_id, None)
+            if not cache_years: continue
+            for cache_year in list(cache_years):
+                if year is None or cache_year is None or cache_year >= year:
+                    cache_years.remove(cache_year)
+                    self._unit_view_cache.pop((unit_id, cache_year), None)
+                    
+    def _view_cache_limit(self):
+        return max(self.VIEW_CACHE_SIZE, self.VIEW_CACHE_YEARS * len(self._get_lifespans()))
+        
+    def _cache_unit_views(self, unit_views, cache_year):
+        limit = self._view_cache_limit()
+        for unit_view in itertools.islice(unit_views, limit // 2):
+            key = (unit_view.id, cache_year)
+            self._unit_view_cache[key] = unit_view
+            self._unit_view_cache.move_to_end(key)
+            self._unit_view_cache_years.setdefault(unit_view.id, set()).add(cache_year)
+        while len(self._unit_view_cache) > limit:
+            (old_unit_id, old_year), old_view = self._unit_view_cache.popitem(last=False)
+            self._unit_view_cache_years[old_unit_id].discard(old_year)
+            
+    def _effective_year(self, year):
+        # Every year at or after the last event in the game shows the same
+        # state, so they share one cache entry (None, "latest").
+        if year is None:
+            return None
+        if not self._latest_year_known:
+            self._latest_year = self.get_min_max_years()[1]
+            self._latest_year_known = True
+        if self._latest_year is None or year >= self._latest_year:
+            return None
+        return year
+        
+    def get_view_cache_stats(self):
+        lookups = self._unit_view_cache_hits + self._unit_view_cache_misses
+        return {
+            "entries": len(self._unit_view_cache),
+            "max_entries": self._view_cache_limit(),
+            "hits": self._unit_view_cache_hits,
+            "misses": self._unit_view_cache_misses,
+            "hit_rate": lookups and self._unit_view_cache_hits / lookups or 0.0,
+        }
+        
+    def _instrumented_methods(self):
+        # every public method, and the per-unit event query
+        import inspect
+        names = [name for name, value in vars(CivTroopManager).items() if inspect.isfunction(value) and not name.startswith("_")]
+        return [name for name in names if name not in self.INSTRUMENTATION_METHODS] + ["_get_unit_events"]
+    INSTRUMENTATION_METHODS = ["enable_instrumentation", "disable_instrumentation", "stats", "reset_stats", "timed", 
+                               "get_view_cache_stats"]
+        
+    def enable_instrumentation(self, slow_query_ms=50):
+        """Start counting SQL statements (via the connection's trace callback) 
+        and time per public method, and logging queries that take longer than
+        slow_query_ms. Costs some speed; read the results with stats()."""
+        if self._instrumentation is not None:
+            return
+        self._instrumentation = Instrumentation(slow_query_ms)
+        self._gameDb = InstrumentedConnection(self._gameDb, self._instrumentation)
+        self._gameDb.set_trace_callback(self._instrumentation.trace)
+        for name in self._instrumented_methods():
+            setattr(self, name, self._instrumentation.wrap(name, getattr(self, name)))
+            
+    def disable_instrumentation(self):
+        if self._instrumentation is None:
+            return
+        for name in self._instrumented_methods():
+            delattr(self, name)
+        self._gameDb.set_trace_callback(None)
+        self._gameDb = self._gameDb.connection
+        self._instrumentation = None
+        
+    def timed(self, name):
+        """Context manager that counts a block of caller code (e.g. a GUI 
+        refresh) under name in stats(), when instrumentation is on."""
+        if self._instrumentation is None:
+            return contextlib.nullcontext()
+        return self._instrumentation.timed(name)
+        
+    def stats(self):
+        """Snapshot of the view cache counters and, if enabled, the
+        instrumentation: SQL statements and times per method, slow queries."""
+        stats = {"view_cache": self.get_view_cache_stats(), "instrumented": self._instrumentation is not None}
+        if self._instrumentation is not None:
+            stats.update(self._instrumentation.snapshot())
+        return stats
+        
+    def reset_stats(self):
+        self._unit_view_cache_hits = 0
+        self._unit_view_cache_misses = 0
+        if self._instrumentation is not None:
+            self._instrumentation.reset()
                 
-    def get_unit_lifespan(self, unit_id):
-        lifespan_events = self._get_unit_events(unit_id, event_types=["create", "destroy"])
-        if len(lifespan_events) < 1:
-            return None, None
-        if len(lifespan_events) > 2:
-            raise Exception("Should be 1 create event, 1 destroy event. Got {}".format(len(lifespan_events)))
+    def _invalidate_checkpoints(self, unit_id, year):
+        # A new or deleted event in 'year' changes every state from that year on.
+        self._gameDb.execute("DELETE FROM unit_checkpoints WHERE unit_id=? AND year>=?", (unit_id, year))
+        
+    def _load_checkpoints(self, unit_ids, year, scan_all, as_of_event_id=None):
+        # Latest checkpoint at or before 'year' (and as_of_event_id within it)
+        # for each unit: {unit_id: (year, event_id, state_json)}
+        query = "SELECT unit_id, year, event_id, state_json FROM unit_checkpoints"
+        conditionals = []
+        params = []
+        if not scan_all:
+            conditionals.append("unit_id IN (%s)" % ",".join("?"*len(unit_ids)))
+            params += unit_ids
+        if as_of_event_id is not None:
+            conditionals.append("(year, event_id)<=(?, ?)")
+            params += [year, as_of_event_id]
+        elif year is not None:
+            conditionals.append("year<=?")
+            params.append(year)
+        if conditionals:
+            query += " WHERE " + " AND ".join(conditionals)
+        query += " ORDER BY unit_id, year, event_id"
+        checkpoints = {}
+        for unit_id, cp_year, cp_event_id, state_json in self._gameDb.execute(query, params):
+            checkpoints[unit_id] = (cp_year, cp_event_id, state_json)
+        return checkpoints
         
-        create_event = lifespan_events[0]
-        if create_event.event_type != "create":
-            raise Exception("The first event should be create but got {}. Internal Error".format(unit_id))
-        create_year = create_event.year
+    def _checkpoint_row(self, unit_view, year, event_id):
+        state = dict((field, getattr(unit_view, field)) for field in self.CHECKPOINT_FIELDS)
+        return (unit_view.id, year, event_id, json.dumps(state))
         
-        if len(lifespan_events) == 2:
-            destroy_year = lifespan_events[1].year
+    def _save_checkpoints(self, rows):
+        # Made while replaying, usually for a plain read. Then they're committed
+        # on their own right away, so the read doesn't leave the connection
+        # holding the write lock. They're only a shortcut, so if the lock is
+        # taken (or the connection is read-only) they're dropped without waiting.
+        own_transaction = not self._gameDb.in_transaction
+        busy_timeout, = self._gameDb.execute("PRAGMA busy_timeout").fetchone()
+        self._gameDb.execute("PRAGMA busy_timeout=0")
+        try:
+            self._gameDb.executemany("INSERT OR REPLACE INTO unit_checkpoints (unit_id, year, event_id, state_json) VALUES (?, ?, ?, ?)", rows)
+            if own_transaction:
+                self._gameDb.commit()
+        except sqlite3.OperationalError:
+            if own_transaction:
+                self._gameDb.rollback()
+        finally:
+            self._gameDb.execute("PRAGMA busy_timeout=%d" % busy_timeout)
+                             
+    def _restore_checkpoint(self, unit_view, state_json):
+        state = json.loads(state_json)
+        for field in self.CHECKPOINT_FIELDS:
+            setattr(unit_view, field, state[field])
+        # json turned the tuples into lists
+        if unit_view.destroyed_by is not None:
+            unit_view.destroyed_by = tuple(unit_view.destroyed_by)
+        unit_view.victories = [tuple(victory) for victory in unit_view.victories]
+                
+    def _rebuild_unit_assignments(self, unit_id, year=None):
+        # Recompute unit_id's assignment intervals from its assign/unassign events.
+        # Returns the composites whose members may have changed from 'year' on.
+        affected = set(self._assignment_composites(unit_id, year))
+        self._gameDb.execute("DELETE FROM unit_assignments WHERE unit_id=?", (unit_id,))
+        intervals = []
+        for e in self._get_unit_events(unit_id, event_types=["assign", "unassign"]):
+            if intervals and intervals[-1][3] is None:
+                intervals[-1][3] = e.year
+            if e.event_type == "assign":
+                intervals.append([unit_id, e.event_data["composite_unit_id"], e.year, None])
+        # assigned and released within the same year: never a member at a year's end
+        intervals = [interval for interval in intervals if interval[3] is None or interval[3] > interval[2]]
+        self._gameDb.executemany("INSERT INTO unit_assignments (unit_id, composite_id, from_year, to_year) VALUES (?, ?, ?, ?)", 
+                                 intervals)
+        affected.update(self._assignment_composites(unit_id, year))
+        return affected
+        
+    def _assignment_composites(self, unit_id, year):
+        query = "SELECT DISTINCT composite_id FROM unit_assignments WHERE unit_id=?"
+        params = [unit_id]
+        if year is not None:
+            query += " AND (to_year IS NULL OR to_year>?)"
+            params.append(year)
+        return [composite_id for composite_id, in self._gameDb.execute(query, params)]
+        
+    def _get_subordinate_units_map(self, composite_unit_ids, year):
+        # {composite_unit_id: [unit_id, ...]} as of 'year' (None for latest)
+        query = "SELECT composite_id, unit_id FROM unit_assignments"
+        conditionals = []
+        params = []
+        if len(composite_unit_ids) <= self.REPLAY_SCAN_ALL_THRESHOLD:
+            conditionals.append("composite_id IN (%s)" % ",".join("?"*len(composite_unit_ids)))
+            params += composite_unit_ids
+        if year is None:
+            conditionals.append("to_year IS NULL")
         else:
-            destroy_year = None
+            conditionals.append("from_year<=? AND (to_year IS NULL OR to_year>?)")
+            params += [year, year]
+        query += " WHERE " + " AND ".join(conditionals) + " ORDER BY from_year, unit_id"
+        subordinate_units = dict((composite_unit_id, []) for composite_unit_id in composite_unit_ids)
+        for composite_unit_id, unit_id in self._gameDb.execute(query, params):
+            if composite_unit_id in subordinate_units:
+                subordinate_units[composite_unit_id].append(unit_id)
+        return subordinate_units
         
-        return create_year, destroy_year
+    def _get_subordinate_units_as_of(self, composite_unit_ids, year, as_of_event_id):
+        # unit_assignments is by year, so start from the year before and
+        # apply this year's assign/unassign events up to as_of_event_id.
+        subordinate_units = self._get_subordinate_units_map(composite_unit_ids, year - 1)
+        joined = dict((composite_unit_id, []) for composite_unit_id in composite_unit_ids)
+        for e in self._select_events(self._event_columns, event_types=["assign", "unassign"], min_year=year, max_year=year, 
+                                     order_by="event_id"):
+            e = self._event_view(e)
+            if e.event_id > as_of_event_id:
+                break
+            for unit_ids in list(subordinate_units.values()) + list(joined.values()):
+                if e.unit_id in unit_ids:
+                    unit_ids.remove(e.unit_id)
+            if e.event_type == "assign" and e.event_data["composite_unit_id"] in joined:
+                joined[e.event_data["composite_unit_id"]].append(e.unit_id)
+        # members that joined this year come last, by unit id, as in _get_subordinate_units_map
+        for composite_unit_id, unit_ids in joined.items():
+            subordinate_units[composite_unit_id] += sorted(unit_ids)
+        return subordinate_units
+        
+    def get_subordinate_units(self, composite_unit_id, year=None):
+        return self._get_subordinate_units_map([composite_unit_id], year)[composite_unit_id]
+        
+    def get_composite_unit_id(self, unit_id, year=None):
+        query = "SELECT composite_id FROM unit_assignments WHERE unit_id=?"
+        if year is None:
+            params = (unit_id,)
+            query += " AND to_year IS NULL"
+        else:
+            params = (unit_id, year, year)
+            query += " AND from_year<=? AND (to_year IS NULL OR to_year>?)"
+        result = self._gameDb.execute(query, params).fetchone()
+        if result is None:
+            return None
+        return result[0]
+                
+    def get_unit_lifespan(self, unit_id):
+        lifespan = self._get_lifespans().get(unit_id, None)
+        if lifespan is None:
+            return None, None
+        return lifespan[0], lifespan[1]
         
     """def create_composite_unit(self, year, name, location):
         self._create_unit(year, name, self.COMPOSITE_UNIT_TYPE, location)
@@ -197,48 +787,76 @@ class CivTroopManager(object):
             raise Exception("Unit type cannot be {}. Reserved.".format(self.COMPOSITE_UNIT_TYPE))
         self._create_unit(year, name, unit_type, location)"""
     
-    def create_unit(self, year, name, unit_type, location):
-        c = self._gameDb.cursor()
-        
-        c.execute("SELECT MAX(unit_id) FROM unit_events")
-        last_unit_id = c.fetchone()[0]
-        if not last_unit_id:
-            last_unit_id = 0
-        new_unit_id = last_unit_id + 1
+    def reserve_unit_ids(self, count=1):
+        """Allocate count new unit ids (for create_unit(..., unit_id=...)) and return them as a range.
+        The ids are never handed out again, even if the transaction is committed without using them."""
+        lifespans = self._get_lifespans()
+        while True:
+            self._gameDb.execute("UPDATE unit_id_sequence SET next_unit_id = next_unit_id + ?", (count,))
+            next_unit_id, = self._gameDb.execute("SELECT next_unit_id FROM unit_id_sequence").fetchone()
+            unit_ids = range(next_unit_id - count, next_unit_id)
+            if not any(unit_id in lifespans for unit_id in unit_ids):
+                return unit_ids
+            # games saved before explicit ids advanced the sequence can have units past it
+            self._advance_unit_id_sequence(max(lifespans) + 1)
+            
+    def _advance_unit_id_sequence(self, next_unit_id):
+        self._gameDb.execute("UPDATE unit_id_sequence SET next_unit_id = MAX(next_unit_id, ?)", (next_unit_id,))
+    
+    def create_unit(self, year, name, unit_type, location, unit_id=None):
+        if unit_id is None:
+            new_unit_id = self.reserve_unit_ids(1)[0]
+        elif unit_id in self._get_lifespans():
+            raise Exception("Unit ID %d already in use" % unit_id)
+        else:
+            new_unit_id = unit_id
+            self._advance_unit_id_sequence(unit_id + 1)
         
         self._insert_unit_event(new_unit_id, year, "create", name=name, unit_type=unit_type, location=location)
+        self._set_unit_lifespan(new_unit_id, year, None, unit_type == self.COMPOSITE_UNIT_TYPE)
         return new_unit_id
         
     def rename_unit(self, unit_id, year, new_name):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
+        if self.is_unit_composite(unit_id):
+            # assigned units' histories show the composite's name
+            self._invalidate_cache(None, year)
         self._insert_unit_event(unit_id, year, "rename", name=new_name)
 
     def upgrade_unit(self, unit_id, year, new_unit_type):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
+        if self.is_unit_composite(unit_id) != (new_unit_type == self.COMPOSITE_UNIT_TYPE):
+            raise Exception("Cannot upgrade a unit to or from a composite.")
         
         self._insert_unit_event(unit_id, year, "upgrade", unit_type=new_unit_type)
                             
     def assign_unit_to_composite(self, unit_id, year, composite_unit_id):
         if not self.is_unit_composite(composite_unit_id):
             raise Exception("Cannot assign a unit to a unit that is not a composite.")
+        if composite_unit_id == unit_id:
+            raise Exception("Cannot assign a unit to itself.")
             
-        self._invalidate_cache(unit_id)
-        self._invalidate_cache(composite_unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
+        self._raise_if_invalid_year(composite_unit_id, year)
         
-        self._insert_unit_event(unit_id, year, "assign", composite_unit_id="composite_unit_id")
+        self._insert_unit_event(unit_id, year, "assign", composite_unit_id=composite_unit_id)
         self._insert_unit_event(composite_unit_id, year, "assign_to", unit_id=unit_id)
+        for affected_unit_id in self._rebuild_unit_assignments(unit_id, year):
+            self._invalidate_cache(affected_unit_id, year)
         
     def unassign_unit_to_composite(self, unit_id, year):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
         
         self._insert_unit_event(unit_id, year, "unassign")
+        for affected_unit_id in self._rebuild_unit_assignments(unit_id, year):
+            self._invalidate_cache(affected_unit_id, year)
                             
     def promote_unit(self, unit_id, year, promotion):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
         if self.is_unit_composite(unit_id):
             raise Exception("Cannot promote a unit that is a composite.")
@@ -246,7 +864,7 @@ class CivTroopManager(object):
         self._insert_unit_event(unit_id, year, "promote", promotion=promotion)
                             
     def move_unit(self, unit_id, year, new_location):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
         
         self._insert_unit_event(unit_id, year, "move", location=new_location)
@@ -254,49 +872,159 @@ class CivTroopManager(object):
     def transfer_unit_hq(self, unit_id, year, new_location):
         #if not self.is_unit_composite(unit_id):
         #    raise Exception("Cannot assign an HQ location to a unit that is not a composite.")
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
         
         self._insert_unit_event(unit_id, year, "transferhq", location=new_location)
         
     def destroy_unit(self, unit_id, year, enemy_unit_owner, enemy_unit_type):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         yearCreated, yearDestroyed = self.get_unit_lifespan(unit_id)
         
         if yearDestroyed != None:
             raise Exception("Unit already destroyed.")
+        self._raise_if_invalid_year(unit_id, year)
         
         self._insert_unit_event(unit_id, year, "destroy", enemy_unit_owner=enemy_unit_owner, enemy_unit_type=enemy_unit_type)
+        self._set_unit_lifespan(unit_id, yearCreated, year, self.is_unit_composite(unit_id))
         
     def disband_unit(self, unit_id, year):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         yearCreated, yearDestroyed = self.get_unit_lifespan(unit_id)
         
         if yearDestroyed != None:
             raise Exception("Unit already destroyed.")
+        self._raise_if_invalid_year(unit_id, year)
         
         self._insert_unit_event(unit_id, year, "destroy", enemy_unit_owner=None, enemy_unit_type=None)
+        self._set_unit_lifespan(unit_id, yearCreated, year, self.is_unit_composite(unit_id))
                             
     def unit_history(self, unit_id, year, note):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
         
         self._insert_unit_event(unit_id, year, "history", note=note)
         
     def unit_victory(self, unit_id, year, enemy_unit_owner, enemy_unit_type):
-        self._invalidate_cache(unit_id)
+        self._invalidate_cache(unit_id, year)
         self._raise_if_invalid_year(unit_id, year)
         
         self._insert_unit_event(unit_id, year, "victory", enemy_unit_owner=enemy_unit_owner, enemy_unit_type=enemy_unit_type)
 
+    def apply_events(self, batch):
+        """Insert a batch of EventRecords. The whole batch is validated (in order,
+        against one snapshot of unit lifespans) before any event is written; then
+        the events go in with one executemany and the caches are invalidated once.
+        Creates without a unit_id get consecutive new ids once the batch has passed;
+        to refer to a new unit later in the same batch, give its create an id from
+        reserve_unit_ids. A batch that fails validation writes nothing, not even to
+        the id sequence. Malformed records raise ValueError. Commit as with the
+        other mutators. Returns the ids of the units created."""
+        lifespans = dict((unit_id, list(lifespan)) for unit_id, lifespan in self._get_lifespans().items())
+        records = []
+        # Nothing is written until every record has passed. Until then a
+        # create without a unit_id is validated under a placeholder key.
+        new_unit_positions = []
+        explicit_unit_ids = []
+        for record in batch:
+            try:
+                unit_id, year, event_type, event_data = record
+            except (TypeError, ValueError):
+                raise ValueError("Batch record %d is not a (unit_id, year, event_type, event_data) record: %r" % (len(records), record))
+            if event_type not in self.EVENT_DATA_FIELDS or event_type == "assign_to":
+                raise ValueError("Cannot apply event type '%s'" % event_type)
+            if not isinstance(event_data, dict) or len(event_data) != len(self.EVENT_DATA_FIELDS[event_type]) or \
+               not all(field in event_data for field in self.EVENT_DATA_FIELDS[event_type]):
+                raise ValueError("Event '%s' needs fields %s, got %r" % (event_type, self.EVENT_DATA_FIELDS[event_type], event_data))
+            if event_type == "create" and unit_id is None:
+                new_unit_positions.append(len(records))
+                unit_id = ("new", len(records))
+            elif event_type == "create":
+                explicit_unit_ids.append(unit_id)
+            records.append([unit_id, year, event_type, event_data])
+            if event_type == "create":
+                if unit_id in lifespans:
+                    raise Exception("Unit ID %d already in use" % unit_id)
+                lifespans[unit_id] = [year, None, event_data["unit_type"] == self.COMPOSITE_UNIT_TYPE]
+                continue
+            if event_type == "destroy" and lifespans.get(unit_id, (None, None, False))[1] is not None:
+                raise Exception("Unit already destroyed.")
+            self._raise_if_invalid_year(unit_id, year, lifespans)
+            if event_type == "destroy":
+                lifespans[unit_id][1] = year
+            elif event_type == "promote" and lifespans[unit_id][2]:
+                raise Exception("Cannot promote a unit that is a composite.")
+            elif event_type == "assign" and not lifespans.get(event_data["composite_unit_id"], (None, None, False))[2]:
+                raise Exception("Cannot assign a unit to a unit that is not a composite.")
+            elif event_type == "assign" and event_data["composite_unit_id"] == unit_id:
+                raise Exception("Cannot assign a unit to itself.")
+            elif event_type == "assign":
+                self._raise_if_invalid_year(event_data["composite_unit_id"], year, lifespans)
+            elif event_type == "upgrade" and lifespans[unit_id][2] != (event_data["unit_type"] == self.COMPOSITE_UNIT_TYPE):
+                raise Exception("Cannot upgrade a unit to or from a composite.")
+        
+        if explicit_unit_ids:
+            # so the ids handed out below (and later) can't be any of these
+            self._advance_unit_id_sequence(max(explicit_unit_ids) + 1)
+        if new_unit_positions:
+            for position, unit_id in zip(new_unit_positions, self.reserve_unit_ids(len(new_unit_positions))):
+                lifespans[unit_id] = lifespans.pop(records[position][0])
+                records[position][0] = unit_id
+        
+        created_unit_ids = []
+        rows = []
+        changed_years = {}
+        changed_lifespans = set()
+        assignment_years = {}
+        composite_rename_year = None
+        for unit_id, year, event_type, event_data in records:
+            if event_type == "create":
+                created_unit_ids.append(unit_id)
+            if event_type in ("create", "destroy"):
+                changed_lifespans.add(unit_id)
+            rows.append(self._event_row(unit_id, year, event_type, event_data))
+            changed_years[unit_id] = min(year, changed_years.get(unit_id, year))
+            if event_type == "assign":
+                composite_unit_id = event_data["composite_unit_id"]
+                rows.append(self._event_row(composite_unit_id, year, "assign_to", {"unit_id": unit_id}))
+                changed_years[composite_unit_id] = min(year, changed_years.get(composite_unit_id, year))
+            if event_type in ("assign", "unassign"):
+                assignment_years[unit_id] = min(year, assignment_years.get(unit_id, year))
+            if event_type == "rename" and lifespans[unit_id][2]:
+                # assigned units' histories show the composite's name
+                if composite_rename_year is None or year < composite_rename_year:
+                    composite_rename_year = year
+        
+        self._gameDb.executemany(self._event_insert_query, rows)
+        if changed_years:
+            # One statement from the earliest change; dropping a few extra checkpoints is cheaper than a DELETE per unit.
+            changed_unit_ids = list(changed_years.keys())
+            for chunk_start in range(0, len(changed_unit_ids), self.REPLAY_SCAN_ALL_THRESHOLD):
+                chunk = changed_unit_ids[chunk_start:chunk_start+self.REPLAY_SCAN_ALL_THRESHOLD]
+                self._gameDb.execute("DELETE FROM unit_checkpoints WHERE year>=? AND unit_id IN (%s)" % ",".join("?"*len(chunk)),
+                                     [min(changed_years.values())] + chunk)
+        for unit_id in changed_lifespans:
+            self._set_unit_lifespan(unit_id, *lifespans[unit_id])
+        for unit_id, year in assignment_years.items():
+            for affected_unit_id in self._rebuild_unit_assignments(unit_id, year):
+                changed_years[affected_unit_id] = min(year, changed_years.get(affected_unit_id, year))
+        
+        if composite_rename_year is not None:
+            self._invalidate_cache(None, composite_rename_year)
+        for unit_id, year in changed_years.items():
+            self._invalidate_cache(unit_id, year)
+        if changed_years:
+            self._latest_year_known = False
+        return created_unit_ids
+        
     def delete_event(self, event_id):
-        query = "SELECT * FROM unit_events WHERE event_id=?"
+        query = "SELECT %s FROM unit_events WHERE event_id=?" % self._event_columns
         c = self._gameDb.cursor()
         c.execute(query, (event_id,))
         result = c.fetchone()
         if not result:
             raise Exception("No such event id to delete")
-        q = self.EventView(*result)
+        q = self._event_view(result)
         to_delete = [q]
         if q.event_type == "create":
             # only permit delete create if all other events are deleted for this unit
@@ -304,151 +1032,630 @@ class CivTroopManager(object):
             if len(unit_events) != 1:
                 raise Exception("Cannot delete a create event unless all other events deleted")
         elif q.event_type == "assign":
-            query = "SELECT * FROM unit_events WHERE unit_id=? AND year=? AND event_type_id=?"
-            params = (q.event_data["composite_unit_id"], q.year, self.EVENT_TYPES.index("assign_to"))
-            c.execute(query, params)
-            result = c.fetchone()
-            if result is None:
+            matching = [e for e in self._get_unit_events(q.event_data["composite_unit_id"], q.year, q.year, ["assign_to"])
+                        if e.event_data["unit_id"] == q.unit_id]
+            if not matching:
                 raise Exception("Database error. No matching 'assign_to'")
-            to_delete.append(self.EventView(*result))
-        elif q.event_type == "assign":
-            query = "SELECT * FROM unit_events WHERE unit_id=? AND year=? AND event_type_id=?"
-            params = (q.event_data["unit_id"], q.year, self.EVENT_TYPES.index("assign"))
-            c.execute(query, params)
-            result = c.fetchone()
-            if result is None:
+            to_delete.append(matching[0])
+        elif q.event_type == "assign_to":
+            matching = [e for e in self._get_unit_events(q.event_data["unit_id"], q.year, q.year, ["assign"])
+                        if e.event_data["composite_unit_id"] == q.unit_id]
+            if not matching:
                 raise Exception("Database error. No matching 'assign'")
-            to_delete.append(self.Eventview(*result))
+            to_delete.append(matching[0])
             
         for del_event in to_delete:
-            self._invalidate_cache(del_event.unit_id)
+            if del_event.event_type == "rename" and self.is_unit_composite(del_event.unit_id):
+                # assigned units' histories show the composite's name
+                self._invalidate_cache(None, del_event.year)
+            else:
+                self._invalidate_cache(del_event.unit_id, del_event.year)
+            self._invalidate_checkpoints(del_event.unit_id, del_event.year)
             query = "DELETE FROM unit_events WHERE event_id=?"
             params = (del_event.event_id,)
             c.execute(query, params)
+            if del_event.event_type == "create":
+                self._delete_unit_lifespan(del_event.unit_id)
+            elif del_event.event_type == "destroy":
+                yearCreated, yearDestroyed = self.get_unit_lifespan(del_event.unit_id)
+                self._set_unit_lifespan(del_event.unit_id, yearCreated, None, self.is_unit_composite(del_event.unit_id))
+            elif del_event.event_type in ("assign", "unassign"):
+                for affected_unit_id in self._rebuild_unit_assignments(del_event.unit_id, del_event.year):
+                    self._invalidate_cache(affected_unit_id, del_event.year)
         
     def get_min_max_years(self):
         c = self._gameDb.cursor()
-        c.execute("SELECT MIN(year), MAX(year) FROM unit_events")
+        # separate subqueries so each is a single seek on unit_events_by_year
+        c.execute("SELECT (SELECT MIN(year) FROM unit_events), (SELECT MAX(year) FROM unit_events)")
         results = c.fetchall()
         if not results: return None, None
         else: return results[0]
     
     def get_unit_list(self, year=None, live_only=False):
-        created = self._get_unit_ids(max_year=year)
-        if live_only:
-            destroyed = self._get_unit_ids(max_year=year, event_types=["destroy"])
-            created = [UID for UID in created if UID not in destroyed] # too slow?
-        return created
+        unit_ids = []
+        for unit_id, (created_year, destroyed_year, is_composite) in self._get_lifespans().items():
+            if year is not None and created_year > year: continue
+            if live_only and destroyed_year is not None and (year is None or destroyed_year <= year): continue
+            unit_ids.append(unit_id)
+        return unit_ids
+        
+    def _find_units(self, key, comparison, value, year, event_types):
+        # Live units whose most recent event_types event as of year has key <comparison> value
+        column = self._search_column(key)
+        type_ids = ",".join(str(self.EVENT_TYPES.index(event_type)) for event_type in event_types)
+        year_filter = ""
+        params = [value]
+        if year is not None:
+            year_filter = " AND {table}.year<=?"
+            params = [value, year, year]
+        query = ("SELECT e.unit_id FROM unit_events e WHERE e.{column} {comparison} ? AND e.event_type_id IN ({types})" + 
+                 year_filter.format(table="e") + 
+                 " AND NOT EXISTS (SELECT 1 FROM unit_events later WHERE later.unit_id=e.unit_id AND later.event_type_id IN ({types})" + 
+                 year_filter.format(table="later") + 
+                 " AND (later.year>e.year OR (later.year=e.year AND later.event_id>e.event_id)))").format(
+                 column=column, comparison=comparison, types=type_ids)
+        live_unit_ids = set(self.get_unit_list(year, live_only=True))
+        return sorted(unit_id for unit_id, in self._gameDb.execute(query, params) if unit_id in live_unit_ids)
+        
+    def find_units_by_name(self, pattern, year=None):
+        """Live units whose name as of year matches pattern, an SQL LIKE pattern 
+        (% and _ wildcards, case insensitive)."""
+        return self._find_units("name", "LIKE", pattern, year, ["create", "rename"])
+        
+    def units_at_location(self, location, year=None):
+        """Live units located at location as of year."""
+        return self._find_units("location", "=", location, year, ["create", "move"])
+        
+    def units_of_type(self, unit_type, year=None):
+        """Live units of unit_type as of year."""
+        return self._find_units("unit_type", "=", unit_type, year, ["create", "upgrade"])
+        
+    def iter_events(self, min_year=None, max_year=None, event_types=None, unit_ids=None, batch_size=1000):
+        """Yields EventViews in (year, event_id) order, fetching batch_size rows 
+        at a time, so the whole game never has to be in memory. Don't write 
+        to the game while iterating."""
+        wanted = None
+        if unit_ids is None:
+            unit_ids = ()
+        elif len(unit_ids) > self.REPLAY_SCAN_ALL_THRESHOLD:
+            wanted = set(unit_ids)
+            unit_ids = ()
+        elif not unit_ids:
+            return
+        c = self._select_events(self._event_columns, tuple(unit_ids), min_year, max_year, event_types, order_by="year, event_id")
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if wanted is None or row[1] in wanted:
+                    yield self._event_view(row)
+        
+    def iter_timeline(self, years=None, per_event=False, deltas=False, display_key=None):
+        """Replays the whole game in one chronological pass, keeping every unit's
+        state as it goes. Yields (year, unit_views) once each year's events are
+        applied, or at each of years (ascending) if given, or (event, unit_views) 
+        after every event if per_event. unit_views holds every unit created so
+        far and is updated in place as the replay continues, so copy what you 
+        keep. With deltas it holds copies of just the units changed since the 
+        last yield instead."""
+        if display_key is None:
+            display_key = self._identity_display_key
+        if years is not None:
+            years = iter(sorted(years))
+            next_year = next(years, None)
+        assign_ids = (self.EVENT_TYPES.index("assign"), self.EVENT_TYPES.index("unassign"))
+        rename_id = self.EVENT_TYPES.index("rename")
+        create_id = self.EVENT_TYPES.index("create")
+        reducers = self._reducers
+        unit_views = {}
+        changed = set()
+        member_since = {}
+        # composite id -> units assigned to it before it was created
+        early_members = {}
+        is_composite = lambda unit_id: unit_id in unit_views and unit_views[unit_id].unit_type == self.COMPOSITE_UNIT_TYPE
+        # History is formatted as of the year last yielded, when it is read
+        history_year = [None]
+        history_loader = lambda unit_view: self._load_unit_history(unit_view, history_year[0])
+        
+        def output(year):
+            history_year[0] = year
+            if not deltas:
+                return unit_views
+            delta = {}
+            year_history_loader = lambda unit_view: self._load_unit_history(unit_view, year)
+            for unit_id in changed:
+                unit_view = unit_views[unit_id]._copy()
+                unit_view.promotions = list(unit_view.promotions)
+                unit_view.victories = list(unit_view.victories)
+                unit_view.subordinate_units = list(unit_view.subordinate_units)
+                unit_view._history_loader = year_history_loader
+                delta[unit_id] = unit_view
+            changed.clear()
+            return delta
+            
+        current_year = None
+        for e in self.iter_events():
+            if years is not None:
+                while next_year is not None and next_year < e.year:
+                    yield next_year, output(next_year)
+                    next_year = next(years, None)
+            elif not per_event and current_year is not None and e.year != current_year:
+                yield current_year, output(current_year)
+            current_year = e.year
+            
+            unit_view = unit_views.get(e.unit_id, None)
+            if unit_view is None:
+                unit_view = unit_views[e.unit_id] = self._new_unit_view(e.unit_id, display_key)
+            composite_unit_id = unit_view.composite_unit_id
+            reducers[e.type_id](unit_view, e.year, e.event_data)
+            unit_view._history_loader = history_loader
+            changed.add(e.unit_id)
+            if e.type_id in assign_ids:
+                # subordinate_units in the same order as _get_subordinate_units_map
+                if is_composite(composite_unit_id) and e.unit_id in unit_views[composite_unit_id].subordinate_units:
+                    unit_views[composite_unit_id].subordinate_units.remove(e.unit_id)
+                    changed.add(composite_unit_id)
+                elif e.unit_id in early_members.get(composite_unit_id, ()):
+                    early_members[composite_unit_id].remove(e.unit_id)
+                if unit_view.composite_unit_id is not None:
+                    member_since[e.unit_id] = e.year
+                if is_composite(unit_view.composite_unit_id):
+                    bisect.insort(unit_views[unit_view.composite_unit_id].subordinate_units, e.unit_id, 
+                                  key=lambda unit_id: (member_since[unit_id], unit_id))
+                    changed.add(unit_view.composite_unit_id)
+                elif unit_view.composite_unit_id is not None:
+                    # Games from before assign checked the composite's lifespan
+                    # can have units assigned to it before it was created.
+                    early_members.setdefault(unit_view.composite_unit_id, []).append(e.unit_id)
+            elif e.type_id == create_id and e.unit_id in early_members:
+                unit_view.subordinate_units = sorted(early_members.pop(e.unit_id), key=lambda unit_id: (member_since[unit_id], unit_id))
+            elif e.type_id == rename_id and unit_view.unit_type == self.COMPOSITE_UNIT_TYPE:
+                # assigned units' histories show the composite's name
+                for other_view in unit_views.values():
+                    other_view._history_loader = history_loader
+            if per_event:
+                yield e, output(e.year)
+                
+        if years is not None:
+            while next_year is not None:
+                yield next_year, output(next_year)
+                next_year = next(years, None)
+        elif not per_event and current_year is not None:
+            yield current_year, output(current_year)
+        
+    def diff_years(self, year_a, year_b):
+        """What changed after year_a, up to and including year_b, from the 
+        events in between. year_a None means from the start of the game."""
+        if year_a is not None and year_b < year_a:
+            raise Exception("diff_years needs year_a <= year_b")
+        diff = self.YearDiff([], [], {}, {}, {}, {}, {})
+        min_year = None
+        if year_a is not None:
+            min_year = year_a + 1
+        event_types = ["create", "destroy", "move", "rename", "upgrade", "assign", "unassign", "promote"]
+        c = self._select_events(self._event_columns, (), min_year, year_b, event_types, order_by="year, event_id")
+        for row in c:
+            e = self._event_view(row)
+            event_type = e.event_type
+            if event_type == "create":
+                diff.created.append(e.unit_id)
+            elif event_type == "destroy":
+                diff.destroyed.append(e.unit_id)
+            elif event_type == "move":
+                diff.moved[e.unit_id] = e.event_data["location"]
+            elif event_type == "rename":
+                diff.renamed[e.unit_id] = e.event_data["name"]
+            elif event_type == "upgrade":
+                diff.upgraded[e.unit_id] = e.event_data["unit_type"]
+            elif event_type == "assign":
+                diff.reassigned[e.unit_id] = e.event_data["composite_unit_id"]
+            elif event_type == "unassign":
+                diff.reassigned[e.unit_id] = None
+            elif event_type == "promote":
+                diff.promoted.setdefault(e.unit_id, []).append(e.event_data["promotion"])
+        return diff
         
     def get_events_list(self, unit_id, year=None):
         return self._get_unit_events(unit_id, max_year=year)
         
+    def get_events_page(self, unit_ids, year=None, after=None, limit=100, descending=False, event_types=None):
+        """Up to limit events of unit_ids as of year, in (year, event_id) order,
+        or newest first if descending. after is the (year, event_id) of the 
+        last event of the previous page; None starts at the oldest (newest
+        if descending) event."""
+        if descending:
+            c = self._select_events(self._event_columns, tuple(unit_ids), None, year, event_types, "year DESC, event_id DESC", 
+                                    before=after, limit=limit)
+        else:
+            c = self._select_events(self._event_columns, tuple(unit_ids), None, year, event_types, "year, event_id", 
+                                    after=after, limit=limit)
+        return [self._event_view(row) for row in c.fetchall()]
         
-    def get_unit_view(self, unit_id,year=None, display_key=None):
+    def get_history_page(self, unit_ids, year=None, after=None, limit=100, descending=False, display_key=None):
+        """Like get_events_page, but returns history entries: 
+        (event_id, year, note, unit_id). Page on with after=(year, event_id) 
+        of the last entry."""
         if display_key is None:
-            display_key = lambda field_name, field_key: field_key
-            
-        if unit_id in self._unit_view_cache.keys():
-            cacheYear, cacheView = self._unit_view_cache[unit_id]
-            # Assume that later than cache year is up-to-date
-            # invalidateCache is supposed to get rid of this after a change
-            if year == None or year >= cacheYear:
-                cacheView.display_key = display_key
-                return cacheView
+            display_key = self._identity_display_key
+        # every other event type has a history note
+        event_types = [event_type for event_type in self.EVENT_TYPES if event_type != "assign_to"]
+        unit_events = self.get_events_page(unit_ids, year, after, limit, descending, event_types)
+        composite_names = self._composite_names(unit_events, year, display_key)
+        return [(event_id, event_year, note, e.unit_id) for e, (event_id, event_year, note) 
+                in zip(unit_events, self._format_history(display_key, unit_events, composite_names))]
+        
+        
+    def get_unit_view(self, unit_id,year=None, display_key=None, as_of_event_id=None):
+        return self.get_unit_views([unit_id], year, display_key, as_of_event_id).get(unit_id, None)
+        
+    def get_unit_views(self, unit_ids, year=None, display_key=None, as_of_event_id=None):
+        """Build views for many units at once. Returns {unit_id: UnitDataView}.
+        Units with no events as of year are left out. With as_of_event_id, 
+        the views show the state right after that event, in its year, and 
+        year is ignored."""
+        self._check_data_version()
+        if display_key is None:
+            display_key = self._identity_display_key
+        if as_of_event_id is not None:
+            return self._get_unit_views_as_of(unit_ids, display_key, as_of_event_id)
+        
+        unit_views = {}
+        to_replay = []
+        cache_year = self._effective_year(year)
+        for unit_id in unit_ids:
+            cache_view = self._unit_view_cache.get((unit_id, cache_year), None)
+            if cache_view is None:
+                to_replay.append(unit_id)
+                continue
+            self._unit_view_cache_hits += 1
+            self._unit_view_cache.move_to_end((unit_id, cache_year))
+            if cache_view.display_key is not display_key:
+                # Don't change the shared view. Copy it, and format history for this key when it is read.
+                cache_view = cache_view._copy()
+                cache_view.display_key = display_key
+                cache_view._history_loader = lambda unit_view: self._load_unit_history(unit_view, year)
+            unit_views[unit_id] = cache_view
+        if not to_replay:
+            return unit_views
+        
+        self._unit_view_cache_misses += len(to_replay)
+        replayed = self._replay_unit_views(to_replay, year, display_key, self._earlier_cached_views(to_replay, year))
+        self._cache_unit_views(replayed.values(), cache_year)
+        unit_views.update(replayed)
+        return unit_views
+        
+    def _earlier_cached_views(self, unit_ids, year):
+        # Moving forward in time: a unit cached at an earlier year only needs
+        # the events after that year applied to a copy of the cached state.
+        start_views = {}
+        for unit_id in unit_ids:
+            earlier_years = [cached_year for cached_year in self._unit_view_cache_years.get(unit_id, ())
+                             if cached_year is not None and (year is None or cached_year < year)]
+            if earlier_years:
+                start_year = max(earlier_years)
+                start_views[unit_id] = (start_year, self._unit_view_cache[(unit_id, start_year)])
+        return start_views
+        
+    def _get_unit_views_as_of(self, unit_ids, display_key, as_of_event_id):
+        # Not cached (the cache is by year), but starts from checkpoints and
+        # cached views of earlier years like any other replay.
+        result = self._gameDb.execute("SELECT year FROM unit_events WHERE event_id=?", (as_of_event_id,)).fetchone()
+        if result is None:
+            raise Exception("No such event id")
+        year, = result
+        return self._replay_unit_views(unit_ids, year, display_key, self._earlier_cached_views(unit_ids, year), as_of_event_id)
+        
+    @staticmethod
+    def _identity_display_key(field_name, field_key):
+        return field_key
+        
+    def _replay_unit_views(self, unit_ids, year, display_key, start_views=None, as_of_event_id=None):
+        # One ordered scan over the events of every requested unit, folding
+        # each event into its unit's view as it goes by. A unit with a 
+        # checkpoint, or an earlier view in start_views ({unit_id: (year, view)}),
+        # starts from the later of the two and skips the events it covers.
+        # With as_of_event_id, events after it in 'year' are left out.
+        wanted = set(unit_ids)
+        # Too many ids for an IN (...) list. Scan everything up to year.
+        scan_all = len(wanted) > self.REPLAY_SCAN_ALL_THRESHOLD
+        if start_views is None:
+            start_views = {}
+        
+        unit_views = {}
+        replay_after = {}
+        checkpoints = self._load_checkpoints(tuple(wanted), year, scan_all, as_of_event_id)
+        for unit_id, (cp_year, cp_event_id, state_json) in checkpoints.items():
+            if unit_id not in wanted: continue
+            if unit_id in start_views and start_views[unit_id][0] >= cp_year: continue
+            unit_view = self._new_unit_view(unit_id, display_key)
+            self._restore_checkpoint(unit_view, state_json)
+            unit_views[unit_id] = unit_view
+            replay_after[unit_id] = (cp_year, cp_event_id)
+        for unit_id, (start_year, start_view) in start_views.items():
+            if unit_id in replay_after: continue
+            unit_view = start_view._copy()
+            unit_view.display_key = display_key
+            unit_view.promotions = list(start_view.promotions)
+            unit_view.victories = list(start_view.victories)
+            unit_view.subordinate_units = []
+            unit_views[unit_id] = unit_view
+            replay_after[unit_id] = (start_year, float("inf"))
+        # Assign history names the composite as of 'year', so even an earlier
+        # view's history can't be reused as is.
+        history_loader = lambda unit_view: self._load_unit_history(unit_view, year, as_of_event_id)
+        for unit_view in unit_views.values():
+            unit_view._history_loader = history_loader
+        
+        min_year = None
+        if replay_after and len(replay_after) >= len(wanted):
+            min_year = min(after_year for after_year, after_event_id in replay_after.values())
+        if scan_all:
+            c = self._select_events(self._event_columns, min_year=min_year, max_year=year, order_by="year, event_id")
         else:
-            cacheYear = None
+            c = self._select_events(self._event_columns, tuple(wanted), min_year, year, order_by="year, event_id")
         
-        unit_events = self._get_unit_events(unit_id, max_year=year)
-        if len(unit_events) == 0:
-            return None
-
+        reducers = self._reducers
+        decode_payload = self._decode_payload
+        events_since_checkpoint = {}
+        checkpoint_years = {}
+        checkpoint_rows = []
+        for event_id, unit_id, event_year, event_type_id, *payload in c:
+            if as_of_event_id is not None and event_year == year and event_id > as_of_event_id: break
+            if unit_id not in wanted: continue
+            if unit_id in replay_after and (event_year, event_id) <= replay_after[unit_id]: continue
+                
+            unit_view = unit_views.get(unit_id, None)
+            if unit_view is None:
+                unit_view = self._new_unit_view(unit_id, display_key)
+                unit_view._history_loader = history_loader
+                unit_views[unit_id] = unit_view
+            reducers[event_type_id](unit_view, event_year, decode_payload(event_type_id, payload))
+                
+            events_since = events_since_checkpoint.get(unit_id, 0) + 1
+            since_year = checkpoint_years.setdefault(unit_id, replay_after.get(unit_id, (event_year,))[0])
+            if ((self.CHECKPOINT_EVENT_INTERVAL and events_since >= self.CHECKPOINT_EVENT_INTERVAL) or
+                (self.CHECKPOINT_YEAR_INTERVAL and event_year - since_year >= self.CHECKPOINT_YEAR_INTERVAL)):
+                checkpoint_rows.append(self._checkpoint_row(unit_view, event_year, event_id))
+                events_since = 0
+                checkpoint_years[unit_id] = event_year
+            events_since_checkpoint[unit_id] = events_since
+        if checkpoint_rows:
+            self._save_checkpoints(checkpoint_rows)
+            
+        composite_ids = [unit_view.id for unit_view in unit_views.values() if unit_view.unit_type == self.COMPOSITE_UNIT_TYPE]
+        if composite_ids and as_of_event_id is not None:
+            for composite_id, subordinate_units in self._get_subordinate_units_as_of(composite_ids, year, as_of_event_id).items():
+                unit_views[composite_id].subordinate_units = subordinate_units
+        elif composite_ids:
+            for composite_id, subordinate_units in self._get_subordinate_units_map(composite_ids, year).items():
+                unit_views[composite_id].subordinate_units = subordinate_units
+        
+        return unit_views
+        
+    def _new_unit_view(self, unit_id, display_key):
         unit_view = self.UnitDataView()
         unit_view.display_key = display_key
         unit_view.id = unit_id
+        return unit_view
         
-        if year == None:
-            lastevent_year = unit_events[-1].year
-        else:
-            lastevent_year = year
+    # Reducers: how each event type changes a unit's state. __init__ puts them
+    # in self._reducers, indexed by event_type_id.
+    def _reduce_create(self, unit_view, year, event_data):
+        unit_view.name = event_data["name"]
+        unit_view.unit_type = event_data["unit_type"]
+        unit_view.location = event_data["location"]
+        if unit_view.unit_type == self.COMPOSITE_UNIT_TYPE:
+            unit_view.HQ = unit_view.location
             
-        units_assigned = []
+    def _reduce_rename(self, unit_view, year, event_data):
+        unit_view.name = event_data["name"]
         
-        for e in unit_events:
-            event_id, event_year, event_type, event_data = e.event_id, e.year, e.event_type, e.event_data
+    def _reduce_upgrade(self, unit_view, year, event_data):
+        unit_view.unit_type = event_data["unit_type"]
+        
+    def _reduce_assign(self, unit_view, year, event_data):
+        unit_view.composite_unit_id = event_data["composite_unit_id"]
+        
+    def _reduce_assign_to(self, unit_view, year, event_data):
+        pass # membership comes from unit_assignments
+        
+    def _reduce_unassign(self, unit_view, year, event_data):
+        unit_view.composite_unit_id = None
+        
+    def _reduce_promote(self, unit_view, year, event_data):
+        unit_view.promotions.append(event_data["promotion"])
+        
+    def _reduce_move(self, unit_view, year, event_data):
+        unit_view.location = event_data["location"]
+        
+    def _reduce_transferhq(self, unit_view, year, event_data):
+        unit_view.HQ = event_data["location"]
+        
+    def _reduce_destroy(self, unit_view, year, event_data):
+        unit_view.is_dead = True
+        if event_data["enemy_unit_owner"] != None:
+            unit_view.destroyed_by = (event_data["enemy_unit_type"], event_data["enemy_unit_owner"])
             
-            if event_type == "create":
-                unit_view.name = event_data["name"]
-                unit_view.unit_type = event_data["unit_type"]
-                unit_view.location = event_data["location"]
-                if unit_view.unit_type == self.COMPOSITE_UNIT_TYPE:
-                    unit_view.HQ = unit_view.location
-                unit_view.history.append((event_id, event_year, 
-                    "%s (%s) created in %s" % (unit_view.display.name, unit_view.display.unit_type, unit_view.display.location)))
-            elif event_type == "rename":
-                unit_view.name = event_data["name"]
-                unit_view.history.append((event_id, event_year, "renamed '%s'" % unit_view.display.name))
-            elif event_type == "upgrade":
-                unit_view.unit_type = event_data["unit_type"]
-                unit_view.history.append((event_id, event_year, "upgraded to '%s'" % unit_view.display.unit_type))
-            elif event_type == "assign":
-                unit_view.composite_unit_id = event_data["composite_unit_id"]
-                composite_unit_view = self.get_unit_view(unit_view.composite_unit_id, year, display_key)
-                unit_view.history.append((event_id, event_year, "assigned to '%s'" % composite_unit_view.name))
-            elif event_type == "assign_to":
-                units_assigned.append(event_data["unit_id"])
-            elif event_type == "unassign":
-                unit_view.history.append((event_id, event_year, "released for independent action"))
-            elif event_type == "promote":
-                promotion = event_data["promotion"]
-                unit_view.history.append((event_id, event_year, "promoted to '%s'" % unit_view.display.promotion))
-            elif event_type == "move":
-                unit_view.location = event_data["location"]
-                unit_view.history.append((event_id, event_year, "location changed to '%s'" % unit_view.display.location))
-            elif event_type == "transferhq":
-                unit_view.HQ = event_data["location"]
-                unit_view.history.append((event_id, event_year, "headquarters transferred to '%s'" % unit_view.display.HQ))
-            elif event_type == "destroy":
-                unit_view.is_dead = True
-                if event_data["destroyed_by"] != None:
-                    enemy_unit_owner, enemy_unit_type = event_data["destroyed_by"]
-                    unit_view.destroyed_by = (enemy_unit_type, enemy_unit_owner)
-                    historyNote = "destroyed by %s's %s unit" % (display_key("player",enemy_unit_owner), display_key("unit_type",enemy_unit_type))
-                else:
-                    historyNote = "disbanded peacefully"
-                unit_view.history.append((event_id, event_year, historyNote))
-            elif event_type == "history":
-                unit_view.history.append((event_id, event_year, event_data["note"]))
-            elif event_type == "victory":
-                enemyunit_type, enemy_unit_owner = event_data["unit_destroyed"]
-                unit_view.victories.append((event_year, enemy_unit_type, enemy_unit_owner))
-                unit_view.history.append((event_id, event_year, "destroyed %s's %s unit" % (display_key("player",enemy_unit_owner), display_key("unit_type",enemy_unit_type))))
-            else:
-                raise Exception("No such event '%s'" % event_type)
+    def _reduce_history(self, unit_view, year, event_data):
+        pass
         
-        if unit_view.unit_type == self.COMPOSITE_UNIT_TYPE:
-            for assigned_unit_id in units_assigned:
-                # these are all units *ever* assigned to this unit. See which ones still are assigned.
-                unit_events = self._get_unit_events(assigned_unit_id, max_year=year, event_types=["assign", "unassigned"])
-                if len(unit_events) == 0:
-                    # This should never happen
-                    raise Exception("Should never happen. Was assigned to, but has not assign events")
-                last_assign_year, last_assign_event, last_assign_data = unit_events[-1]
-                if last_assign_event == "assign":
-                    composite_unit_id = last_assign_data["composite_unit_id"]
-                else:
-                    composite_unit_id = None
-
-                if composite_unit_id == unit_id:
-                    # as of 'year' (or latest), still assigned to me
-                    unit_view.subordinate_units.append(assigned_unit_id)
-                
-        # Sort on date only.
-        unit_view.history.sort(key=lambda historyItem: historyItem[0])
-        if cacheYear == None or lastevent_year >= cacheYear:
-            # This should prevent getting an older version of the unit
-            # stuck in the cache.
-            self._unit_view_cache[unit_view.id] = (lastevent_year, unit_view)
-        return unit_view        
+    def _reduce_victory(self, unit_view, year, event_data):
+        unit_view.victories.append((year, event_data["enemy_unit_type"], event_data["enemy_unit_owner"]))
+        
+    # History formatters: the history text of each event type, or None for
+    # none. In self._history_formatters, indexed by event_type_id.
+    def _history_create(self, display_key, event_data, composite_names):
+        return "%s (%s) created in %s" % (display_key("name", event_data["name"]), 
+                                          display_key("unit_type", event_data["unit_type"]), 
+                                          display_key("location", event_data["location"]))
+                                          
+    def _history_rename(self, display_key, event_data, composite_names):
+        return "renamed '%s'" % display_key("name", event_data["name"])
+        
+    def _history_upgrade(self, display_key, event_data, composite_names):
+        return "upgraded to '%s'" % display_key("unit_type", event_data["unit_type"])
+        
+    def _history_assign(self, display_key, event_data, composite_names):
+        return "assigned to '%s'" % composite_names[event_data["composite_unit_id"]]
+        
+    def _history_assign_to(self, display_key, event_data, composite_names):
+        return None
+        
+    def _history_unassign(self, display_key, event_data, composite_names):
+        return "released for independent action"
+        
+    def _history_promote(self, display_key, event_data, composite_names):
+        return "promoted to '%s'" % display_key("promotion", event_data["promotion"])
+        
+    def _history_move(self, display_key, event_data, composite_names):
+        return "location changed to '%s'" % display_key("location", event_data["location"])
+        
+    def _history_transferhq(self, display_key, event_data, composite_names):
+        return "headquarters transferred to '%s'" % display_key("HQ", event_data["location"])
+        
+    def _history_destroy(self, display_key, event_data, composite_names):
+        if event_data["enemy_unit_owner"] == None:
+            return "disbanded peacefully"
+        return "destroyed by %s's %s unit" % (display_key("player", event_data["enemy_unit_owner"]), 
+                                              display_key("unit_type", event_data["enemy_unit_type"]))
+                                              
+    def _history_history(self, display_key, event_data, composite_names):
+        return event_data["note"]
+        
+    def _history_victory(self, display_key, event_data, composite_names):
+        return "destroyed %s's %s unit" % (display_key("player", event_data["enemy_unit_owner"]), 
+                                           display_key("unit_type", event_data["enemy_unit_type"]))
+    
+    def _composite_names(self, unit_events, year, display_key):
+        # Assign history names the composite as of 'year', not as of the event.
+        composite_ids = set(e.event_data["composite_unit_id"] for e in unit_events if e.event_type == "assign")
+        composite_views = self.get_unit_views(list(composite_ids), year, display_key)
+        return dict((cId, composite_view.name) for cId, composite_view in composite_views.items())
+            
+    def _format_history(self, display_key, unit_events, composite_names):
+        history = []
+        for e in unit_events:
+            note = self._history_formatters[e.type_id](display_key, e.event_data, composite_names)
+            if note is not None:
+                history.append((e.event_id, e.year, note))
+        return history
+        
+    def _load_unit_history(self, unit_view, year, as_of_event_id=None):
+        unit_events = self._get_unit_events(unit_view.id, max_year=year)
+        if as_of_event_id is not None:
+            unit_events = [e for e in unit_events if e.year < year or e.event_id <= as_of_event_id]
+        composite_names = self._composite_names(unit_events, year, unit_view.display_key)
+        return self._format_history(unit_view.display_key, unit_events, composite_names)
             
+# Batch commands for the command line: name -> (method, argument types).
+# "unit" arguments also take $N, the Nth unit created earlier in the batch.
+CLI_COMMANDS = {
+    "create": ("create_unit", ["year", "str", "str", "str"]),
+    "rename": ("rename_unit", ["unit", "year", "str"]),
+    "upgrade": ("upgrade_unit", ["unit", "year", "str"]),
+    "assign": ("assign_unit_to_composite", ["unit", "year", "unit"]),
+    "unassign": ("unassign_unit_to_composite", ["unit", "year"]),
+    "promote": ("promote_unit", ["unit", "year", "str"]),
+    "move": ("move_unit", ["unit", "year", "str"]),
+    "transferhq": ("transfer_unit_hq", ["unit", "year", "str"]),
+    "destroy": ("destroy_unit", ["unit", "year", "str", "str"]),
+    "disband": ("disband_unit", ["unit", "year"]),
+    "history": ("unit_history", ["unit", "year", "str"]),
+    "victory": ("unit_victory", ["unit", "year", "str", "str"]),
+    "delete": ("delete_event", ["int"]),
+}
+
+def run_cli_batch(manager, lines):
+    """Runs batch command lines (shell-style quoting, # comments) in one
+    transaction; nothing is kept if any fails. Returns the created unit ids."""
+    import shlex
+    created = []
+    with manager:
+        for line_number, line in enumerate(lines, 1):
+            words = shlex.split(line, comments=True)
+            if not words: continue
+            try:
+                if words[0] not in CLI_COMMANDS:
+                    raise Exception("Unknown command '%s'" % words[0])
+                method, argument_types = CLI_COMMANDS[words[0]]
+                if len(words) - 1 != len(argument_types):
+                    raise Exception("'%s' takes %d arguments" % (words[0], len(argument_types)))
+                args = []
+                for argument_type, word in zip(argument_types, words[1:]):
+                    if argument_type == "unit" and word.startswith("$"):
+                        if not word[1:].isdigit() or not 1 <= int(word[1:]) <= len(created):
+                            raise Exception("no unit %s created yet in this batch" % word)
+                        args.append(created[int(word[1:])-1])
+                    elif argument_type == "str":
+                        args.append(word)
+                    else:
+                        args.append(int(word))
+                result = getattr(manager, method)(*args)
+                if words[0] == "create":
+                    created.append(result)
+            except Exception as e:
+                raise Exception("line %d: %s" % (line_number, e))
+    return created
+    
+def cli_main(args):
+    # Headless front end: no tkinter, and only the stdlib modules the model needs.
+    import argparse, os
+    parser = argparse.ArgumentParser(prog="c4tm_model.py", description="Query or update a game database without the GUI.")
+    parser.add_argument("game", help="game database file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run batch commands (%s) in one transaction" % ", ".join(CLI_COMMANDS))
+    run_parser.add_argument("script", nargs="?", default="-", help="command file, or - for stdin")
+    unit_parser = commands.add_parser("unit", help="one unit's view")
+    unit_parser.add_argument("unit_id", type=int)
+    unit_parser.add_argument("--year", type=int)
+    unit_parser.add_argument("--as-of-event", type=int)
+    unit_parser.add_argument("--history", action="store_true")
+    army_parser = commands.add_parser("army", help="every unit's view at a year")
+    army_parser.add_argument("--year", type=int)
+    army_parser.add_argument("--live", action="store_true", help="leave out destroyed units")
+    events_parser = commands.add_parser("events", help="events in a year range")
+    events_parser.add_argument("--min-year", type=int)
+    events_parser.add_argument("--max-year", type=int)
+    events_parser.add_argument("--unit", type=int, action="append", dest="unit_ids")
+    events_parser.add_argument("--type", action="append", dest="event_types", choices=CivTroopManager.EVENT_TYPES)
+    diff_parser = commands.add_parser("diff", help="what changed after year_a up to year_b")
+    diff_parser.add_argument("year_a", type=int)
+    diff_parser.add_argument("year_b", type=int)
+    options = parser.parse_args(args)
+    
+    if options.command != "run" and not os.path.exists(options.game):
+        parser.error("no such game database: %s" % options.game)
+    from c4tm_db import connect
+    manager = CivTroopManager(connect(options.game))
+    try:
+        if options.command == "run":
+            if options.script == "-":
+                created = run_cli_batch(manager, sys.stdin)
+            else:
+                with open(options.script) as script:
+                    created = run_cli_batch(manager, script)
+            result = {"created": created}
+        elif options.command == "unit":
+            unit_view = manager.get_unit_view(options.unit_id, options.year, as_of_event_id=options.as_of_event)
+            if unit_view is None:
+                raise Exception("No such unit with ID %d" % options.unit_id)
+            result = unit_view.as_dict(options.history)
+        elif options.command == "army":
+            unit_views = manager.get_unit_views(manager.get_unit_list(options.year, options.live), options.year)
+            result = [unit_views[unit_id].as_dict() for unit_id in sorted(unit_views)]
+        elif options.command == "events":
+            # streamed, one event per line
+            for e in manager.iter_events(options.min_year, options.max_year, options.event_types, options.unit_ids):
+                sys.stdout.write(json.dumps(e.as_dict()) + "\n")
+            return 0
+        elif options.command == "diff":
+            result = manager.diff_years(options.year_a, options.year_b)._asdict()
+    except Exception as e:
+        sys.stdout.write(json.dumps({"error": str(e)}) + "\n")
+        return 1
+    sys.stdout.write(json.dumps(result) + "\n")
+    return 0
+    
 if __name__=="__main__":
-    pass # todo create command line interface. Maybe maintenance mode for delete
\ No newline at end of file
+    sys.exit(cli_main(sys.argv[1:]))
\ No newline at end of file
@@ -0,0 +1,296 @@
+#!/usr/bin/python
+# Read-only JSON API over a game database, so a campaign can be viewed from
+# browsers and scripts while it is edited in the GUI.
+#   python c4tm_server.py GAME [--host 127.0.0.1] [--port 8040] [--readers 4]
+#
+#   GET /units?year=Y[&live=1]                      every unit's view
+#   GET /units/<id>?year=Y[&as_of_event=E][&history=1]
+#   GET /events?min_year=&max_year=[&unit=ID ...][&type=T ...]
+#   GET /diff?year_a=&year_b=
+#
+# Responses carry an ETag that changes whenever another connection commits
+# to the game, so unchanged data costs a 304 and no queries.
+#
+# The server never writes to the game. A game whose schema is older than
+# this version of c4tm_model is refused; opening it once in the GUI (or with
+# c4tm_model.py) upgrades it. Games the GUI has opened are already in WAL
+# mode. In any other mode a request in progress holds up the GUI's commits.
+import json, threading, collections, contextlib, os, sys, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from c4tm_model import CivTroopManager
+from c4tm_db import GameDatabase, connect
+
+class GameReader(object):
+    """State shared by the request handlers: the reader pool and a manager
+    for each of its connections, the change counter, the shared view cache
+    and the cached responses."""
+    RESPONSE_CACHE_SIZE = 256
+    # (unit_id, year) -> unit view as_dict, shared by every pooled manager
+    VIEW_CACHE_SIZE = 65536
+
+    def __init__(self, filename, readers=4):
+        if not os.path.exists(filename):
+            raise Exception("No such game database: %s" % filename)
+        self._filename = filename
+
+        # PRAGMA data_version on this connection changes whenever another
+        # connection commits. Each change starts a new generation.
+        self._monitor = connect(filename, read_only=True, check_same_thread=False)
+        self._monitor_lock = threading.Lock()
+        self._check_schema_version(self._monitor)
+        self.journal_mode, = self._monitor.execute("PRAGMA journal_mode").fetchone()
+        self._data_version = self._read_data_version()
+        self._generation = 0
+        self._etag_prefix = "%x" % int(1000 * time.time())
+
+        # id(reader connection) -> [generation, manager], made when the pool
+        # opens the connection, before any read transaction
+        self._managers = {}
+        self._database = GameDatabase(filename, readers, read_only=True, on_open_reader=self._open_manager)
+
+        self._views = collections.OrderedDict()
+        self._views_generation = 0
+        self._views_lock = threading.Lock()
+
+        # (generation, path and query) -> response body
+        self._responses = collections.OrderedDict()
+        self._responses_lock = threading.Lock()
+
+    def _check_schema_version(self, gameDb):
+        schema_version, = gameDb.execute("PRAGMA user_version").fetchone()
+        if schema_version != len(CivTroopManager.SCHEMA_MIGRATIONS):
+            raise Exception("{} has schema version {}, this server reads version {}. Open it in the troop manager "
+                            "(or with c4tm_model.py) to upgrade it.".format(self._filename, schema_version,
+                                                                          len(CivTroopManager.SCHEMA_MIGRATIONS)))
+
+    def _open_manager(self, gameDb):
+        manager = CivTroopManager(gameDb)
+        # replay would save checkpoints, which a read-only connection can't
+        manager.CHECKPOINT_EVENT_INTERVAL = None
+        manager.CHECKPOINT_YEAR_INTERVAL = None
+        self._managers[id(gameDb)] = [None, manager]
+
+    def _read_data_version(self):
+        data_version, = self._monitor.execute("PRAGMA data_version").fetchone()
+        return data_version
+
+    def generation(self):
+        with self._monitor_lock:
+            data_version = self._read_data_version()
+            if data_version != self._data_version:
+                self._data_version = data_version
+                self._generation += 1
+            return self._generation
+
+    def etag(self, generation):
+        return '"%s-%d"' % (self._etag_prefix, generation)
+
+    @contextlib.contextmanager
+    def read(self):
+        """A pooled manager inside one read transaction, and the generation
+        of the state that transaction sees: (generation, manager)."""
+        while True:
+            generation = self.generation()
+            with self._database.reader() as gameDb:
+                # The first read fixes the transaction's snapshot. If nothing
+                # was committed between reading the generation and here, the
+                # snapshot is that generation's; otherwise try again.
+                self._check_schema_version(gameDb)
+                if self.generation() != generation:
+                    continue
+                # only this thread has gameDb until the with ends
+                entry = self._managers[id(gameDb)]
+                if entry[0] != generation:
+                    entry[1].reload()
+                    entry[0] = generation
+                yield generation, entry[1]
+                return
+
+    def cached_views(self, generation, year, unit_ids):
+        """{unit_id: view dict} for those of unit_ids with a view at year
+        cached in this generation."""
+        with self._views_lock:
+            if generation != self._views_generation:
+                return {}
+            views = {}
+            for unit_id in unit_ids:
+                view = self._views.get((unit_id, year), None)
+                if view is not None:
+                    self._views.move_to_end((unit_id, year))
+                    views[unit_id] = view
+            return views
+
+    def cache_views(self, generation, year, views):
+        with self._views_lock:
+            if generation < self._views_generation:
+                return
+            if generation > self._views_generation:
+                self._views.clear()
+                self._views_generation = generation
+            for unit_id, view in views.items():
+                self._views[(unit_id, year)] = view
+            while len(self._views) > self.VIEW_CACHE_SIZE:
+                self._views.popitem(last=False)
+
+    def cached_response(self, generation, key):
+        with self._responses_lock:
+            body = self._responses.get((generation, key), None)
+            if body is not None:
+                self._responses.move_to_end((generation, key))
+            return body
+
+    def cache_response(self, generation, key, body):
+        with self._responses_lock:
+            self._responses[(generation, key)] = body
+            while len(self._responses) > self.RESPONSE_CACHE_SIZE:
+                self._responses.popitem(last=False)
+
+    def close(self):
+        self._monitor.close()
+        self._database.close()
+
+def _int_arg(query, name, required=False):
+    values = query.get(name, None)
+    if not values:
+        if required:
+            raise Exception("Missing parameter '%s'" % name)
+        return None
+    try:
+        return int(values[-1])
+    except ValueError:
+        raise Exception("Parameter '%s' must be an integer" % name)
+
+def _flag_arg(query, name):
+    return query.get(name, ["0"])[-1] not in ("", "0", "false")
+
+def _unit_views(reader, generation, manager, unit_ids, year):
+    # through the shared view cache
+    views = reader.cached_views(generation, year, unit_ids)
+    missing = [unit_id for unit_id in unit_ids if unit_id not in views]
+    if missing:
+        computed = dict((unit_id, unit_view.as_dict()) for unit_id, unit_view in manager.get_unit_views(missing, year).items())
+        reader.cache_views(generation, year, computed)
+        views.update(computed)
+    return views
+
+# Each returns (generation, result); result None for 404.
+def get_units(reader, query):
+    year = _int_arg(query, "year")
+    with reader.read() as (generation, manager):
+        unit_ids = sorted(manager.get_unit_list(year, _flag_arg(query, "live")))
+        views = _unit_views(reader, generation, manager, unit_ids, year)
+        return generation, [views[unit_id] for unit_id in unit_ids if unit_id in views]
+
+def get_unit(reader, query, unit_id):
+    year = _int_arg(query, "year")
+    as_of_event_id = _int_arg(query, "as_of_event")
+    history = _flag_arg(query, "history")
+    with reader.read() as (generation, manager):
+        if as_of_event_id is not None or history:
+            unit_view = manager.get_unit_view(unit_id, year, as_of_event_id=as_of_event_id)
+            return generation, unit_view and unit_view.as_dict(history)
+        if unit_id not in manager.get_unit_list(year):
+            return generation, None
+        return generation, _unit_views(reader, generation, manager, [unit_id], year).get(unit_id, None)
+
+def get_events(reader, query):
+    unit_ids = [int(unit_id) for unit_id in query.get("unit", [])] or None
+    event_types = query.get("type", None)
+    for event_type in event_types or []:
+        if event_type not in CivTroopManager.EVENT_TYPES:
+            raise Exception("Unknown event type '%s'" % event_type)
+    with reader.read() as (generation, manager):
+        return generation, [e.as_dict() for e in manager.iter_events(_int_arg(query, "min_year"), _int_arg(query, "max_year"),
+                                                                     event_types, unit_ids)]
+
+def get_diff(reader, query):
+    with reader.read() as (generation, manager):
+        return generation, manager.diff_years(_int_arg(query, "year_a"), _int_arg(query, "year_b", required=True))._asdict()
+
+class GameRequestHandler(BaseHTTPRequestHandler):
+    # set on the subclass made by make_server
+    reader = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        generation = self.reader.generation()
+        etag = self.reader.etag(generation)
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self._send(304, None, etag)
+            return
+        body = self.reader.cached_response(generation, self.path)
+        if body is None:
+            try:
+                routed = self._route(url.path, parse_qs(url.query))
+            except Exception as e:
+                self._send(400, json.dumps({"error": str(e)}).encode())
+                return
+            if routed is None or routed[1] is None:
+                self._send(404, json.dumps({"error": "Not found"}).encode())
+                return
+            # the generation the data was read at, which a commit since may have moved on from
+            generation, result = routed
+            etag = self.reader.etag(generation)
+            body = json.dumps(result).encode()
+            self.reader.cache_response(generation, self.path, body)
+        self._send(200, body, etag)
+
+    def _route(self, path, query):
+        parts = [part for part in path.split("/") if part]
+        if parts == ["units"]:
+            return get_units(self.reader, query)
+        if len(parts) == 2 and parts[0] == "units" and parts[1].isdigit():
+            return get_unit(self.reader, query, int(parts[1]))
+        if parts == ["events"]:
+            return get_events(self.reader, query)
+        if parts == ["diff"]:
+            return get_diff(self.reader, query)
+        return None
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+def make_server(filename, host="127.0.0.1", port=8040, readers=4):
+    reader = GameReader(filename, readers)
+    handler = type("GameRequestHandler", (GameRequestHandler,), {"reader": reader})
+    return ThreadingHTTPServer((host, port), handler)
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog="c4tm_server.py", description="Serve a game database as read-only JSON.")
+    parser.add_argument("game", help="game database file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8040)
+    parser.add_argument("--readers", type=int, default=4, help="pooled read-only connections")
+    options = parser.parse_args(args)
+    if not os.path.exists(options.game):
+        parser.error("no such game database: %s" % options.game)
+    try:
+        server = make_server(options.game, options.host, options.port, options.readers)
+    except Exception as e:
+        parser.error(str(e))
+    if server.RequestHandlerClass.reader.journal_mode.lower() != "wal":
+        print("%s is in %s journal mode, not WAL: the GUI's commits will wait for requests in progress" %
+              (options.game, server.RequestHandlerClass.reader.journal_mode))
+    print("Serving %s on http://%s:%d/" % (options.game, options.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.RequestHandlerClass.reader.close()
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
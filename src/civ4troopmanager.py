@@ -1,14 +1,22 @@
 #!/usr/bin/python
 # REQUIRES PYTHON 3.0!
+# The tkinter front-end. Scripts that don't need a window import c4tm_core
+# and c4tm_model instead, which don't load Tk.
 
-from tkinter import *
+from tkinter import (Tk, Toplevel, Frame, Label, Entry, Button, Checkbutton, Listbox, Scrollbar, Menu,
+                     StringVar, IntVar, END, ACTIVE, DISABLED, BROWSE, MULTIPLE, SUNKEN, LEFT, RIGHT, BOTH, X, Y)
 from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
-from tkinter.messagebox import *
+from tkinter.messagebox import showinfo, askyesno
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 from c4tm_model import CivTroopManager
+from c4tm_core import GameDataDisplayKey, ComputeStrength, entry_to_int
+from c4tm_db import GameDatabase
 from civgamedata import CivGameData
-import sqlite3
+import sys
+
+# History entries fetched at a time by the delete event and details windows
+HISTORY_PAGE_SIZE = 100
 
 def entrySet(entry, text):
     entry.delete(0, END)
@@ -16,79 +24,19 @@ def entrySet(entry, text):
     
 def capitalizeFirst(s):
     return s[0].upper()+s[1:]
-    
-class GameDataDisplayKey:
-    def __init__(self, game_data):
-        self._game_data = game_data
-        
-    def get_unit_type_display(self, unit_type_key):
-        unit_type_data = self._game_data.get_unit_type(unit_type_key)
-        if unit_type_data is None: return unit_type_key
-        return unit_type_data.get("display", unit_type_key) 
-        
-    def __call__(self, field_type, field_key):
-        if field_type == "unit_type":
-            return self.get_unit_type_display(field_key)
-        return field_key
-
-class ComputeStrength(object):
-    def __init__(self, unit_data, game_data):
-        self._unit_data = unit_data
-        self._game_data = game_data
-        
-    def unit_type_strength(self, unit_type):
-        unit_type_data = self._game_data.get_unit_type(unit_type)
-        if not unit_type_data:
-            raise Exception("No Such UnitType")
-        return unit_type_data["strength"]
-        
-    def aggregate_strength(self, unit_view, year=None):
-        if unit_view.unit_type == self._unit_data.COMPOSITE_UNIT_TYPE:
-            aggregate_strength = 0
-            for sub_unit in unit_view.subordinate_units:
-                sub_unit_view = self.manager.get_unit_view(sub_unit, self._game_data, year, GameDataDisplayKey(self._game_data))
-                aggregate_strength += self.aggregate_strength(sub_unit_view, year)
-        else:
-            aggregate_strength = self.unit_type_strength(unit_view.unit_type)
-        return aggregate_strength
-        
-    def average_strength(self, unit_view, year=None):
-        if unit_view.unit_type == self._unit_data.COMPOSITE_UNIT_TYPE:
-            sub_unit_count = len(unit_view.subordinate_units)
-            if sub_unit_count == 0: return 0
-            
-            aggregate_strength = self.aggregate_strength(unitView, year)
-            average_strength = aggregate_strength / float(sub_unit_count)
-        else:
-            average_strength = self.unit_type_strength(unit_view.unit_type)
-        return average_strength
-        
-    def composite(self, unit_view, year=None):
-        if unit_view.unit_type == self._unit_data.COMPOSITE_UNIT_TYPE:
-            return "%d (%0.2f/%d)" % (self.aggregate_strength(unit_view, year), 
-                                    self.average_strength(unit_view, year), 
-                                    len(unit_view.subordinateUnits))
-        else:
-            return "%d%s" % (self.aggregate_strength(unit_view, year), "+"*len(unit_view.promotions))
 
 def gui_entry_to_int(field_name, entry_data, min_val=None, max_val=None):
     try:
-        i_val = int(entry_data)
-    except:
-        showinfo('Error', "{} value [{}] is invalid.".format(field_name, entry_data))
-        return None 
-    if min_val is not None and i_val < min_val:
-        showinfo('Error', "{} value {} too small. Minimum value is {}".format(field_name, i_val, min_val))
+        return entry_to_int(field_name, entry_data, min_val, max_val)
+    except Exception as e:
+        showinfo('Error', str(e))
         return None
-    if max_val is not None and i_val > max_val:
-        showinfo('Error', "{} value {} too big. Maximum value is {}".format(field_name, i_val, max_val))       
-        return None
-    return i_val
 
 class SelectionBox(object):
     def __init__(self, parent, label, items, selection_change_cb=None, display_key=None):
         self._items = items
         self._display_items = items
+        self._display_key = display_key
         if display_key:
             self._display_items = [display_key(i) for i in items]
         self._selection_change_cb = selection_change_cb
@@ -118,6 +66,14 @@ class SelectionBox(object):
     def selected(self):
         return self._selectedVar.get()
         
+    def add_items(self, items):
+        display_items = items
+        if self._display_key:
+            display_items = [self._display_key(i) for i in items]
+        self._items = self._items + items
+        self._display_items = self._display_items + display_items
+        self._selectBox.insert(END, *display_items)
+        
     def selected_index(self):
         return self._selectBox.curselection()[0]
         
@@ -666,18 +622,36 @@ class DeleteUnitEventDialog(OkCancelContinueDialog):
         
         self.yearHint = yearHint
         
-        unitEvents = []
+        # newest first, a page at a time
         self.unitEventMapping = {}
-        for eventData in self.unitView.display.history:
-            eventId, eventYear, eventNote = eventData
-            displayName = "%d. %s (event id %d)" % (eventYear, eventNote, eventId)
-            unitEvents.append(displayName)
-            self.unitEventMapping[displayName] = eventId
-        unitEvents.reverse()
+        self._lastEventKey = None
+        unitEvents = self._nextEventPage()
         self.unitEventSelect = SelectionBox(top, "Unit Events as of year %d" % yearHint, unitEvents)
         self.unitEventSelect.frame.pack()
+        self._olderButton = Button(top, text="Load Older Events", command=self._loadOlderEvents)
+        if len(unitEvents) < HISTORY_PAGE_SIZE:
+            self._olderButton.config(state=DISABLED)
+        self._olderButton.pack()
         
         self._insertButtonFrame(rename_save="Delete")
+        
+    def _nextEventPage(self):
+        unitEvents = []
+        historyPage = self.manager.get_history_page([self.unit], self.yearHint, self._lastEventKey, HISTORY_PAGE_SIZE, 
+                                                    descending=True, display_key=self.unitView.display_key)
+        for eventId, eventYear, eventNote, unitId in historyPage:
+            displayName = "%d. %s (event id %d)" % (eventYear, eventNote, eventId)
+            unitEvents.append(displayName)
+            self.unitEventMapping[displayName] = eventId
+        if historyPage:
+            self._lastEventKey = (historyPage[-1][1], historyPage[-1][0])
+        return unitEvents
+        
+    def _loadOlderEvents(self):
+        unitEvents = self._nextEventPage()
+        self.unitEventSelect.add_items(unitEvents)
+        if len(unitEvents) < HISTORY_PAGE_SIZE:
+            self._olderButton.config(state=DISABLED)
 
     def _ok(self):
         selectedEvent = self.unitEventSelect.selected()
@@ -1052,6 +1026,7 @@ class CreateOrEditPromotionTypeDialog(object):
 
 class Civ4TroopManager_tkinterView(object):
     def __init__(self, databaseName=None, game_data_file=None):
+        self._gameDatabase = None
         self._troopManagerModel = None
         self._strengthModel = None
         self.initView()
@@ -1180,6 +1155,10 @@ class Civ4TroopManager_tkinterView(object):
         unittypemenu.add_command(label="Create Promotion Type", command=self._createPromotionType)
         unittypemenu.add_command(label="Edit Promotion Type", command=self._editPromotionType)
         menubar.add_cascade(label="Definitions", menu=unittypemenu)
+        
+        toolsmenu = Menu(menubar, tearoff=0)
+        toolsmenu.add_command(label="Diagnostics", command=self._showDiagnostics)
+        menubar.add_cascade(label="Tools", menu=toolsmenu)
 
         self._root.config(menu=menubar)
     
@@ -1187,11 +1166,17 @@ class Civ4TroopManager_tkinterView(object):
         self._root.mainloop()
         
     def _openDatabase(self, filename):
-        gameDb = sqlite3.connect(filename)
-        self._troopManagerModel = CivTroopManager(gameDb)
+        self._gameDatabase = GameDatabase(filename)
+        self._troopManagerModel = CivTroopManager(self._gameDatabase.writer)
         self._strengthModel = ComputeStrength(self._troopManagerModel, self._game_data)
         self._fillTree()
         
+    def _closeDatabase(self):
+        self._troopManagerModel = None
+        if self._gameDatabase:
+            self._gameDatabase.close()
+            self._gameDatabase = None
+        
     def _getSelectedUnit(self):
         curTreeSelections = self._armyList.selection()
         if len(curTreeSelections) == 1:
@@ -1236,18 +1221,20 @@ class Civ4TroopManager_tkinterView(object):
             entrySet(self._yearEntry, year)
         else:
             year = self._getYear()
-        if self._displayFlatVar.get() == 0:
-            self._fillTreeHierarchy(selectedUnit, year)
-        else:
-            self._fillTreeFlat(selectedUnit, year)
+        with self._troopManagerModel.timed("fill tree"):
+            if self._displayFlatVar.get() == 0:
+                self._fillTreeHierarchy(selectedUnit, year)
+            else:
+                self._fillTreeFlat(selectedUnit, year)
         
     def _fillTreeHierarchy(self, selectedUnit=None, selectedYear=None):
         self._armyList.delete(*self._armyList.get_children())
         
         unitIdList = self._troopManagerModel.get_unit_list(selectedYear)
+        unitViews = self._troopManagerModel.get_unit_views(unitIdList, selectedYear, self._display_key)
         unitIdMap = {}
         for unitId in unitIdList:
-            unitView = self._troopManagerModel.get_unit_view(unitId, selectedYear, self._display_key)
+            unitView = unitViews[unitId]
             if self._displayDeadVar.get() == 0 and unitView.is_dead: continue
             if unitView.id in unitIdMap: continue
             unitTreeId = self._insertToTree(unitView, selectedYear)
@@ -1258,7 +1245,9 @@ class Civ4TroopManager_tkinterView(object):
                     self._armyList.move(unitTreeId, parentTreeId, 0)
                     break
                 else:
-                    parentUnitView = self._troopManagerModel.get_unit_view(unitView.composite_unit_id, selectedYear)
+                    parentUnitView = unitViews.get(unitView.composite_unit_id, None)
+                    if parentUnitView is None:
+                        parentUnitView = self._troopManagerModel.get_unit_view(unitView.composite_unit_id, selectedYear, self._display_key)
                     parentTreeId = self._insertToTree(parentUnitView, selectedYear)
                     unitIdMap[parentUnitView.id] = parentTreeId
                     self._armyList.move(unitTreeId, parentTreeId, 0)
@@ -1271,15 +1260,15 @@ class Civ4TroopManager_tkinterView(object):
         self._armyList.delete(*self._armyList.get_children())
         
         unitIdList = self._troopManagerModel.get_unit_list(selectedYear)
-        for unitId in unitIdList:
-            unitView = self._troopManagerModel.get_unit_view(unitId, selectedYear)
+        unitViews = self._troopManagerModel.get_unit_views(unitIdList, selectedYear, self._display_key)
+        for unitView in unitViews.values():
             if self._displayDeadVar.get() == 0 and unitView.is_dead: continue
             self._insertToTree(unitView, selectedYear)
         
     def _newGame(self):
         if self._troopManagerModel:
             if askyesno('Close Current Game', 'A game database is already in use. Close it?'):
-                self._troopManagerModel = None
+                self._closeDatabase()
             else:
                 showinfo('Cancelled', 'New game has been cancelled')
                 return
@@ -1289,15 +1278,14 @@ class Civ4TroopManager_tkinterView(object):
             if not gameDbFilename:
                 showinfo('Cancelled', 'New game has been cancelled')
                 return
-            gameDb = sqlite3.connect(gameDbFilename)
-            
-            self._troopManagerModel = CivTroopManager(gameDb)
+            self._gameDatabase = GameDatabase(gameDbFilename)
+            self._troopManagerModel = CivTroopManager(self._gameDatabase.writer)
             self._strengthModel = ComputeStrength(self._troopManagerModel, self._game_data)
             
     def _openGame(self):
         if self._troopManagerModel:
             if askyesno('Close Current Game', 'A game database is already in use. Close it?'):
-                self._troopManagerModel = None
+                self._closeDatabase()
             else:
                 showinfo('Cancelled', 'Open game has been cancelled')
                 return
@@ -1352,26 +1340,25 @@ class Civ4TroopManager_tkinterView(object):
                 s += "\t%s: %d\n" % (promotion, promotionCount)
             return s
             
-    def _getCompositeHistoryString(self, topUnitId, recursiveData=None):
+    def _getCompositeUnitIds(self, topUnitId):
         unitView = self._troopManagerModel.get_unit_view(topUnitId, display_key=self._display_key)
-        unit_view_in_year = lambda y: self._troopManagerModel.get_unit_view(topUnitId, y, display_key=self._display_key)
-        if recursiveData == None:
-            historyData = []
-        else: historyData = recursiveData
-        for historyRecord in unitView.display.history:
-            eventId, year, note = historyRecord
-            historyData.append((year, eventId, note, unit_view_in_year(year).display.name))
+        unitIds = [topUnitId]
         for subUnitId in unitView.subordinate_units:
-            self._getCompositeHistoryString(subUnitId, historyData)
-        if recursiveData == None:
-            # top level. Produce string
-            s = ""
-            historyData.sort() # Should sort on year
-            for historyRecord in historyData:
-                year, eventId, note, unitName = historyRecord
-                s += "\t%d: Unit %s. %s (event %d)\n" % (year, unitName, note, eventId)
-            #print("composite history string:\n" + s)
-            return s
+            unitIds += self._getCompositeUnitIds(subUnitId)
+        return unitIds
+        
+    def _getCompositeHistoryPage(self, unitIds, after=None):
+        # The next HISTORY_PAGE_SIZE history entries of all the units, by year.
+        # Returns the text and the key to pass as after for the page after.
+        historyPage = self._troopManagerModel.get_history_page(unitIds, after=after, limit=HISTORY_PAGE_SIZE, 
+                                                               display_key=self._display_key)
+        s = ""
+        for eventId, year, note, unitId in historyPage:
+            unitName = self._troopManagerModel.get_unit_view(unitId, year, display_key=self._display_key).display.name
+            s += "\t%d: Unit %s. %s (event %d)\n" % (year, unitName, note, eventId)
+        if historyPage:
+            after = (historyPage[-1][1], historyPage[-1][0])
+        return s, after, len(historyPage) == HISTORY_PAGE_SIZE
     
     def _getCompositeSubunitString(self, topUnitId, prefix="\t"):
         unitView = self._troopManagerModel.get_unit_view(topUnitId, display_key=self._display_key)
@@ -1436,6 +1423,8 @@ HISTORY       :
         else:
             compositeUnit = "<None>"
         victoryCount, victoryString = self._getCompositeVictoryCountAndString(unitView.id)
+        historyUnitIds = self._getCompositeUnitIds(unitView.id)
+        historyString, historyAfter, moreHistory = self._getCompositeHistoryPage(historyUnitIds)
         details = {
             "name": unitView.display.name,
             "type": unitView.display.unit_type,
@@ -1446,11 +1435,58 @@ HISTORY       :
             "hq": unitView.display.HQ,
             "promotions": self._getCompositePromotionsString(unitView.id),
             "subunits": self._getCompositeSubunitString(unitView.id),
-            "history": self._getCompositeHistoryString(unitView.id)
+            "history": historyString
         }
         sc.insert('insert', detailsTemplate % details)
         sc.grid(row=0, column=0, sticky="nsew")
         
+        if moreHistory:
+            historyState = [historyAfter]
+            def loadMoreHistory():
+                historyString, historyState[0], moreHistory = self._getCompositeHistoryPage(historyUnitIds, historyState[0])
+                # history is last, before the template's closing newline
+                sc.insert("end-2c", historyString)
+                if not moreHistory:
+                    moreButton.config(state=DISABLED)
+            moreButton = Button(top, text="More History", command=loadMoreHistory)
+            moreButton.grid(row=1, column=0)
+        
+    def _getDiagnosticsString(self, stats):
+        s = "VIEW CACHE    : %d/%d entries, %d hits, %d misses (%0.1f%% hit rate)\n" % (
+            stats["view_cache"]["entries"], stats["view_cache"]["max_entries"], stats["view_cache"]["hits"], 
+            stats["view_cache"]["misses"], 100 * stats["view_cache"]["hit_rate"])
+        s += "SQL STATEMENTS: %d\n\n" % stats["sql_statements"]
+        s += "%-30s %8s %8s %10s %10s\n" % ("METHOD", "CALLS", "SQL", "TOTAL MS", "MAX MS")
+        for name, method in sorted(stats["methods"].items(), key=lambda item: -item[1]["total_ms"]):
+            s += "%-30s %8d %8d %10.1f %10.1f\n" % (name, method["calls"], method["sql"], method["total_ms"], method["max_ms"])
+        s += "\nSLOW QUERIES (over %g ms, newest first)\n" % stats["slow_query_ms"]
+        for query in reversed(stats["slow_queries"]):
+            s += "%10.1f ms  %s: %s\n" % (query["ms"], query["method"], query["sql"])
+        return s
+        
+    def _showDiagnostics(self):
+        if not self._troopManagerModel:
+            showinfo("Not Ready", "No Open Database")
+            return
+        top = Toplevel(self._root)
+        top.title("Diagnostics")
+        sc = ScrolledText(top, width=120)
+        sc.grid(row=0, column=0, columnspan=2, sticky="nsew")
+        def refresh():
+            if not self._troopManagerModel:
+                return
+            # Stays on for the game from here on. Enabling again is a no-op.
+            self._troopManagerModel.enable_instrumentation()
+            sc.delete("1.0", END)
+            sc.insert("insert", self._getDiagnosticsString(self._troopManagerModel.stats()))
+        def reset():
+            if self._troopManagerModel:
+                self._troopManagerModel.reset_stats()
+            refresh()
+        Button(top, text="Refresh", command=refresh).grid(row=1, column=0)
+        Button(top, text="Reset", command=reset).grid(row=1, column=1)
+        refresh()
+        
     def _assignMetaUnit(self, selectedUnitId=None, yearHint=None, onContinue=None):
         if not self._troopManagerModel:
             showinfo("Not Ready", "No Open Database")
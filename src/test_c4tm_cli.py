@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# Batch runs of the c4tm_model command line: all or nothing, and errors name
+# the script line.
+#   python -m unittest test_c4tm_cli
+import contextlib, io, json, os, shutil, sqlite3, tempfile, unittest
+from c4tm_model import CivTroopManager, cli_main
+
+class CliBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, "game.db")
+        manager = CivTroopManager(sqlite3.connect(self.filename))
+        self.unit_id = manager.create_unit(-4000, "Warriors", "warrior", "Rome")
+        manager.commit()
+        manager.connection.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def dump(self):
+        gameDb = sqlite3.connect(self.filename)
+        try:
+            return dict((table, gameDb.execute("SELECT * FROM %s ORDER BY 1" % table).fetchall())
+                        for table in ("unit_events", "unit_lifespans", "unit_assignments", "unit_id_sequence"))
+        finally:
+            gameDb.close()
+
+    def run_script(self, script):
+        script_name = os.path.join(self.temp_dir, "turn.txt")
+        with open(script_name, "w") as script_file:
+            script_file.write(script)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = cli_main([self.filename, "run", script_name])
+        return status, json.loads(output.getvalue())
+
+    def test_batch(self):
+        status, result = self.run_script("create -3900 'Legion' warrior Rome\n"
+                                         "move $1 -3850 Antium\n"
+                                         "promote %d -3850 Combat1\n" % self.unit_id)
+        self.assertEqual(status, 0)
+        self.assertEqual(len(result["created"]), 1)
+        self.assertEqual(len(self.dump()["unit_events"]), 4)
+
+    def test_bad_line_rolls_back(self):
+        before = self.dump()
+        status, result = self.run_script("# turn 12\n"
+                                         "create -3900 'Legion' warrior Rome\n"
+                                         "\n"
+                                         "move $1 -3850 Antium\n"
+                                         "move %d -5000 Antium\n"
+                                         "promote %d -3850 Combat1\n" % (self.unit_id, self.unit_id))
+        self.assertEqual(status, 1)
+        self.assertTrue(result["error"].startswith("line 5: Cannot insert an event in year -5000"), result["error"])
+        self.assertEqual(self.dump(), before)
+
+    def test_bad_unit_reference(self):
+        before = self.dump()
+        status, result = self.run_script("create -3900 'Legion' warrior Rome\n"
+                                         "move $2 -3850 Antium\n")
+        self.assertEqual(status, 1)
+        self.assertEqual(result["error"], "line 2: no unit $2 created yet in this batch")
+        self.assertEqual(self.dump(), before)
+
+    def test_unknown_command(self):
+        before = self.dump()
+        status, result = self.run_script("move %d -3850 Antium\n"
+                                         "teleport %d -3850 Antium\n" % (self.unit_id, self.unit_id))
+        self.assertEqual(status, 1)
+        self.assertEqual(result["error"], "line 2: Unknown command 'teleport'")
+        self.assertEqual(self.dump(), before)
+
+if __name__=="__main__":
+    unittest.main()
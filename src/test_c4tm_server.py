@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# Runs c4tm_server on a temporary game and edits it from another connection.
+#   python -m unittest test_c4tm_server
+import json, os, shutil, tempfile, threading, unittest, urllib.error, urllib.request
+from c4tm_model import CivTroopManager
+from c4tm_db import connect
+import c4tm_server
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, "game.db")
+        # the editing side, as the GUI opens it
+        self.manager = CivTroopManager(connect(self.filename))
+        self.army_id = self.manager.create_unit(-4000, "Army", CivTroopManager.COMPOSITE_UNIT_TYPE, "Rome")
+        self.unit_id = self.manager.create_unit(-4000, "Warriors", "warrior", "Rome")
+        self.manager.assign_unit_to_composite(self.unit_id, -3990, self.army_id)
+        self.manager.commit()
+
+        self.server = c4tm_server.make_server(self.filename, port=0)
+        self.server.RequestHandlerClass.log_message = lambda *args: None
+        self.reader = self.server.RequestHandlerClass.reader
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.reader.close()
+        self.manager.connection.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get(self, path, etag=None):
+        request = urllib.request.Request("http://127.0.0.1:%d%s" % (self.server.server_port, path),
+                                         headers=etag and {"If-None-Match": etag} or {})
+        try:
+            with urllib.request.urlopen(request) as response:
+                body = response.read()
+                return response.status, response.headers.get("ETag"), body and json.loads(body)
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get("ETag"), None
+
+    def test_etag_changes_on_commit(self):
+        status, etag, units = self.get("/units")
+        self.assertEqual(status, 200)
+        self.assertEqual([unit["location"] for unit in units], ["Rome", "Rome"])
+        self.assertEqual(self.get("/units", etag)[:2], (304, etag))
+        # other paths share the generation, so the same ETag
+        self.assertEqual(self.get("/units/%d" % self.unit_id, etag)[0], 304)
+
+        self.manager.move_unit(self.unit_id, -3950, "Antium")
+        self.manager.commit()
+        status, new_etag, units = self.get("/units", etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(units[1]["location"], "Antium")
+        self.assertEqual(self.get("/units/%d" % self.unit_id)[2]["location"], "Antium")
+        self.assertEqual(self.get("/units", new_etag)[0], 304)
+
+    def test_uncommitted_edits_are_not_seen(self):
+        etag = self.get("/units")[1]
+        self.manager.move_unit(self.unit_id, -3950, "Antium")
+        self.assertEqual(self.get("/units", etag)[0], 304)
+        self.manager.undo()
+        self.assertEqual(self.get("/units", etag)[0], 304)
+
+    def test_read_sees_one_snapshot(self):
+        with self.reader.read() as (generation, manager):
+            self.assertEqual(manager.get_unit_view(self.unit_id).location, "Rome")
+            self.manager.move_unit(self.unit_id, -3950, "Antium")
+            self.manager.commit()
+            # the commit is after this transaction's snapshot
+            self.assertEqual(manager.get_unit_view(self.unit_id, -3900).location, "Rome")
+            self.assertEqual([e.event_type for e in manager.iter_events(unit_ids=[self.unit_id])], ["create", "assign"])
+            self.assertTrue(manager.connection.in_transaction)
+        with self.reader.read() as (new_generation, manager):
+            self.assertGreater(new_generation, generation)
+            self.assertEqual(manager.get_unit_view(self.unit_id, -3900).location, "Antium")
+
+    def test_errors(self):
+        self.assertEqual(self.get("/units/999")[0], 404)
+        self.assertEqual(self.get("/nowhere")[0], 404)
+        self.assertEqual(self.get("/units?year=soon")[0], 400)
+        self.assertEqual(self.get("/diff")[0], 400)
+
+class OutdatedGameTest(unittest.TestCase):
+    def test_refused_without_writing(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, "old.db")
+            gameDb = connect(filename)
+            gameDb.execute("CREATE TABLE unit_events (event_id integer PRIMARY KEY, unit_id integer, year integer, "
+                           "event_type_id integer, event_json text)")
+            gameDb.commit()
+            gameDb.close()
+            with open(filename, "rb") as game:
+                before = game.read()
+            with self.assertRaises(Exception):
+                c4tm_server.GameReader(filename)
+            with open(filename, "rb") as game:
+                self.assertEqual(game.read(), before)
+        finally:
+            shutil.rmtree(temp_dir)
+
+if __name__=="__main__":
+    unittest.main()